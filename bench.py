@@ -0,0 +1,315 @@
+import argparse
+import contextlib
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+from pathlib import Path
+
+
+def timed(func, items, repeat):
+    """Best wall time of `repeat` passes of func over items, in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            func(item)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_parse(limit=None, repeat=3):
+    """Compare the legacy one-parse-per-field extraction with PaperPage over the cached HF paper pages."""
+    from cache import hfp_cache_manager
+    from process import PaperPage, extract_abstract, extract_href_with_text, extract_upvote_count
+
+    def legacy(content):
+        return dict(
+            paper_of_the_day=extract_href_with_text(content, 'Paper of the day', silent=True),
+            pdf_link=extract_href_with_text(content, 'View PDF'),
+            abstract=extract_abstract(content),
+            upvotes=extract_upvote_count(content),
+            arxiv_link=extract_href_with_text(content, 'View arXiv page'),
+        )
+
+    def single(content, parser):
+        page = PaperPage(content, parser=parser)
+        return dict(
+            paper_of_the_day=page.paper_of_the_day,
+            pdf_link=page.pdf_link,
+            abstract=page.abstract,
+            upvotes=page.upvotes,
+            arxiv_link=page.arxiv_link,
+        )
+
+    pages = []
+    for _, content in islice(hfp_cache_manager.items(), limit):
+        try:
+            pages.append((content, legacy(content)))
+        except ValueError:
+            continue
+    if not pages:
+        print(f"No parsable pages in {hfp_cache_manager.db_file}")
+        return
+
+    contents = [content for content, _ in pages]
+    variants = [("legacy (5 x html.parser)", legacy),
+                ("PaperPage html.parser", lambda content: single(content, 'html.parser'))]
+    try:
+        import lxml
+        variants.append(("PaperPage lxml", lambda content: single(content, 'lxml')))
+    except ImportError:
+        print("lxml is not installed, skipping the lxml variant")
+
+    for name, func in variants[1:]:
+        mismatches = sum(func(content) != expected for content, expected in pages)
+        if mismatches:
+            print(f"Warning: {name} disagrees with the legacy extraction on {mismatches} pages")
+
+    print(f"{len(pages)} pages, {sum(map(len, contents)) / 1e6:.1f} MB of HTML, best of {repeat}")
+    baseline = None
+    for name, func in variants:
+        seconds = timed(func, contents, repeat)
+        baseline = baseline or seconds
+        print(f"{name:<28}{seconds:>8.2f}s {1000 * seconds / len(contents):>8.2f} ms/page {baseline / seconds:>6.1f}x")
+
+
+def synthetic_papers(num_rows):
+    return [dict(notes="", pick="", title=f"Paper {i}", tldr="tldr " * 60, affiliations="University; Lab",
+                 upvote=num_rows - i, paperOfTheDay=None, abstract="abstract " * 150, date="2024-08-12",
+                 arXiv=f"https://arxiv.org/abs/2408.{i:05d}", url=f"https://huggingface.co/papers/2408.{i:05d}",
+                 arXivPdf=f"https://arxiv.org/pdf/2408.{i:05d}")
+            for i in range(num_rows)]
+
+
+def bench_sheets(sizes=(50, 500, 5000), repeat=3):
+    """Body size and round-trip time of the column wrap formatting, per-cell updateCells vs repeatCell."""
+    from gsheet import GSheet, payload_size
+    from stubs import SheetsStub, serve, sheets_service
+
+    server, base_url = serve(SheetsStub())
+    service = sheets_service(base_url)
+    columns = ['notes', 'title', 'tldr', 'affiliations']
+
+    print(f"{'rows':>6}{'updateCells bytes':>19}{'ms':>8}{'repeatCell bytes':>18}{'ms':>8}")
+    for num_rows in sizes:
+        gsheet = GSheet(synthetic_papers(num_rows), "bench", service=service, deferred=True)
+        gsheet.create_spreadsheet()
+        spreadsheet_id = gsheet.commit()
+
+        legacy = {'requests': [{
+            "updateCells": {
+                "range": {"sheetId": 0, "startRowIndex": 1, "endRowIndex": num_rows + 1,
+                          "startColumnIndex": gsheet.column_names.index(col),
+                          "endColumnIndex": gsheet.column_names.index(col) + 1},
+                "rows": [{"values": [{"userEnteredFormat": {"wrapStrategy": "WRAP"}}]} for _ in range(num_rows)],
+                "fields": "userEnteredFormat.wrapStrategy"
+            }
+        } for col in columns]}
+        gsheet.format_columns(columns, {"wrapStrategy": "WRAP"})
+        current = {'requests': gsheet.format_requests}
+
+        row = f"{num_rows:>6}"
+        for body in (legacy, current):
+            request = service.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body=body)
+            seconds = timed(lambda _: request.execute(), [None], repeat)
+            row += f"{payload_size(body):>19}{1000 * seconds:>8.1f}"
+        print(row)
+    server.shutdown()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def recorded_week(days, week=None):
+    """Monday and recorded days of `week`, by default the latest week with a cached listing."""
+    monday = week or max(days)
+    monday = datetime.strptime(monday, '%Y-%m-%d')
+    monday -= timedelta(days=monday.weekday())
+    week_days = [(monday + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(5)]
+    return week_days[0], [day for day in week_days if day in days]
+
+
+@contextlib.contextmanager
+def replay_dir(source, cold_llm):
+    """Run in a scratch directory holding a copy of the caches, the originals are never written."""
+    ignore = ['batches', '*.sqlite-shm'] + (['completions'] if cold_llm else [])
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='papers-replay-') as scratch:
+        shutil.copytree(source, Path(scratch) / '.cache', ignore=shutil.ignore_patterns(*ignore))
+        (Path(scratch) / '.data').mkdir()
+        os.chdir(scratch)
+        try:
+            yield Path(scratch)
+        finally:
+            os.chdir(cwd)
+
+
+def offline_get(url, *args, **kwargs):
+    raise RuntimeError(f"Offline replay: {url} is not in the recorded caches")
+
+
+def bench_replay(source='.cache', week=None, latency=0.2, workers=1, reviewed=10, cold_llm=False):
+    """Replay a recorded week end to end: retrieve and dedup from the caches, enrich, build the sheet, review.
+
+    HF pages and PDFs come only from the copied caches (anything missing fails like a network
+    error would), OpenAI and Sheets calls go to the local stubs with `latency` seconds per response.
+    With cold_llm the completion caches are left out so every LLM call reaches the stub.
+    """
+    import http_client
+    import llm
+    import main
+    import tracing
+    from dedup import dedup_papers
+    from openai import OpenAI
+    from stubs import OpenAIStub, SheetsStub, serve, sheets_service
+
+    openai_server, openai_url = serve(OpenAIStub(latency=latency))
+    sheets_server, sheets_url = serve(SheetsStub(latency=latency))
+    os.environ['OPENAI_BASE_URL'] = f"{openai_url}/v1"
+    os.environ['OPENAI_API_KEY'] = 'stub'
+
+    source = Path(source).resolve()
+    online_get = http_client.get
+    stages = []
+    start = time.perf_counter()
+    with replay_dir(source, cold_llm):
+        # The stores are opened relative to the working directory, so the copies are used
+        from cache import hf_cache_manager
+        monday, days = recorded_week(hf_cache_manager.keys(), week)
+        if not days:
+            print(f"No recorded listings in {source}")
+            return
+        print(f"Replaying the week of {monday}: {', '.join(days)}")
+
+        http_client.get = offline_get
+        llm.set_client(OpenAI())
+        tracing.enable()
+        try:
+            stage_start = time.perf_counter()
+            results = main.map_ordered(main.retrieve_day, days, workers=workers)
+            papers = [paper for _, day_papers, _, _ in results for paper in day_papers or []]
+            stages.append(("retrieve", len(papers), "papers", time.perf_counter() - stage_start))
+            main.print_day_summary(results)
+
+            stage_start = time.perf_counter()
+            papers = dedup_papers(papers)
+            stages.append(("dedup", len(papers), "papers", time.perf_counter() - stage_start))
+
+            stage_start = time.perf_counter()
+            papers = sorted(main.enrich_papers(papers, workers=main.PAPER_WORKERS * workers),
+                            key=lambda paper: paper['upvote'], reverse=True)
+            stages.append(("enrich", len(papers), "papers", time.perf_counter() - stage_start))
+            if not papers:
+                print("No papers could be replayed")
+                return
+
+            stage_start = time.perf_counter()
+            spreadsheet_id = main.build_sheet(papers, f"Paper Review: {monday}", service=sheets_service(sheets_url))
+            stages.append(("sheet", len(papers), "rows", time.perf_counter() - stage_start))
+
+            # Recorded weeks carry no notes, review the most upvoted papers and pick the first
+            reviewed_papers = [dict(paper, notes=f"Notes on {paper['title']}") for paper in papers[:reviewed]]
+            stage_start = time.perf_counter()
+            main.generate_review_aux(reviewed_papers[:1], reviewed_papers, monday, spreadsheet_id,
+                                     picked_paper_short_title="Replay")
+            stages.append(("review", len(reviewed_papers) + 1, "completions", time.perf_counter() - stage_start))
+        finally:
+            http_client.get = online_get
+            llm.set_client(None)
+            openai_server.shutdown()
+            sheets_server.shutdown()
+
+        print()
+        tracing.print_summary()
+
+    print()
+    print(f"{'stage':<10}{'items':>8}{'':<13}{'seconds':>9}{'items/s':>10}")
+    for name, items, unit, seconds in stages:
+        print(f"{name:<10}{items:>8} {unit:<12}{seconds:>9.2f}{items / seconds:>10.1f}")
+    print(f"wall time {time.perf_counter() - start:.2f}s, peak RSS {peak_rss_mb():.0f} MB, "
+          f"stub latency {latency * 1000:.0f} ms{', cold LLM caches' if cold_llm else ''}")
+
+
+# Packages the quick commands must not import, main.py imports them inside the modes that use them
+HEAVY_PACKAGES = ('googleapiclient', 'google.cloud', 'google_auth_oauthlib', 'openai', 'PyPDF2', 'bs4', 'requests')
+STARTUP_COMMANDS = (['--help'], ['publish'])
+STARTUP_BUDGET = 0.5
+
+
+def import_times(args, cwd):
+    """Wall seconds of `python -X importtime main.py *args` and the {module: cumulative seconds} it reported."""
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', str(Path(__file__).parent / 'main.py'), *args],
+                            capture_output=True, text=True, cwd=cwd)
+    seconds = time.perf_counter() - start
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative) / 1e6
+    return seconds, times
+
+
+def heavy_imports(times):
+    """Modules of HEAVY_PACKAGES among the imported ones, sorted."""
+    return sorted(name for name in times if name.split('.')[0] in HEAVY_PACKAGES or name.startswith(HEAVY_PACKAGES))
+
+
+def bench_imports(budget=STARTUP_BUDGET):
+    """Check that the quick commands stay quick: no heavy package imported and wall time under budget.
+
+    Exits with status 1 on a regression. test_imports.py runs the heavy package check under pytest.
+    """
+    failures = []
+    with tempfile.TemporaryDirectory(prefix='papers-imports-') as cwd:
+        for args in STARTUP_COMMANDS:
+            seconds, times = import_times(args, cwd)
+            command = ' '.join(['main.py'] + args)
+            heavy = heavy_imports(times)
+            slowest = sorted(times.items(), key=lambda item: item[1], reverse=True)[:3]
+            print(f"{command:<20}{seconds:>6.2f}s wall  slowest imports: "
+                  f"{', '.join(f'{name} {t * 1e3:.0f} ms' for name, t in slowest)}")
+            if heavy:
+                failures.append(f"{command} imports {', '.join(heavy[:5])}{' ...' if len(heavy) > 5 else ''}")
+            if seconds > budget:
+                failures.append(f"{command} took {seconds:.2f}s, over the {budget:.2f}s budget")
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    if failures:
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Micro-benchmarks over the local caches and stubs.")
+    parser.add_argument("benchmark", choices=["parse", "sheets", "replay", "imports"], help="Benchmark to run")
+    parser.add_argument("--limit", type=int, default=None, help="Maximum number of cached items to use")
+    parser.add_argument("--repeat", type=int, default=3, help="Passes per variant, the best one is reported")
+    parser.add_argument("--cache", default=".cache", help="replay: cache directory holding the recorded week")
+    parser.add_argument("--week", default=None, help="replay: any day of the week to replay (default: the latest)")
+    parser.add_argument("--latency", type=float, default=0.2, help="replay: seconds added to every stub response")
+    parser.add_argument("--workers", type=int, default=1, help="replay: days retrieved in parallel")
+    parser.add_argument("--reviewed", type=int, default=10, help="replay: number of papers reviewed")
+    parser.add_argument("--cold-llm", action="store_true", help="replay: leave out the cached completions")
+    args = parser.parse_args()
+
+    if args.benchmark == "parse":
+        bench_parse(limit=args.limit, repeat=args.repeat)
+    elif args.benchmark == "sheets":
+        bench_sheets(repeat=args.repeat)
+    elif args.benchmark == "replay":
+        bench_replay(source=args.cache, week=args.week, latency=args.latency, workers=args.workers,
+                     reviewed=args.reviewed, cold_llm=args.cold_llm)
+    elif args.benchmark == "imports":
+        bench_imports()
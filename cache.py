@@ -2,9 +2,16 @@ import base64
 import functools
 import gzip
 import json
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from collections import Counter
+from itertools import islice
 from pathlib import Path
 
-import requests
+from tracing import count
 
 def cache_dir():
     return Path('./.cache')
@@ -45,57 +52,282 @@ def cache_result(cache_filename):
 
 
 def cache_request_get(url, cache_filename):
+    import http_client
+
     @cache_result(cache_filename=cache_filename)
     def do_work():
-        return (requests.get(url)).content
+        return http_client.get(url).content
 
     return do_work()
 
 
+# Record encodings. gzip is the default, zdict is raw deflate with a preset dictionary trained
+# on the cache's own entries, zstd needs the optional zstandard package.
+CODECS = ('gzip', 'zdict', 'zstd')
+ZDICT_SIZE = 32 * 1024
+ZSTD_DICT_SIZE = 112 * 1024
+DICT_SAMPLES = 200
+
+
+def train_zdict(samples):
+    """Build a deflate preset dictionary from the markup and phrases shared between samples."""
+    counts = Counter()
+    for sample in samples:
+        counts.update(set(re.findall(r'<[^<>]{4,200}>|[^<>]{16,200}', sample)))
+
+    segments = []
+    size = 0
+    for segment, occurrences in counts.most_common():
+        encoded = segment.encode('utf-8')
+        if occurrences < 2 or size + len(encoded) > ZDICT_SIZE:
+            break
+        segments.append(encoded)
+        size += len(encoded)
+
+    if not segments:
+        return ''.join(samples).encode('utf-8')[-ZDICT_SIZE:]
+    # deflate reaches the end of the dictionary most cheaply, put the most common segments there
+    return b''.join(reversed(segments))
+
+
+def zstandard_module():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("The zstd codec needs the zstandard package: pip install zstandard")
+    return zstandard
+
+
 class CacheManager:
+    """Key/value cache stored in SQLite next to the legacy JSONL log (same name, .sqlite suffix).
+
+    Opening is O(1): the database is only connected on first use and responses are
+    decompressed one at a time in get_cached_response. An existing JSONL log is
+    migrated once, the first time its database is created.
+    """
+
     def __init__(self, cache_file, loads):
         self.cache_file = cache_file
+        self.db_file = cache_file.with_suffix('.sqlite')
         self.loads = loads
-        self.cache = self.load_cache()
-
-    def load_cache(self):
-        cache = {}
-        if self.cache_file.exists():
+        self.lock = threading.RLock()
+        self._connection = None
+        self.codec = 'gzip'
+        self.dictionaries = {}
+
+    @property
+    def connection(self):
+        with self.lock:
+            if self._connection is None:
+                migrate = self.cache_file.exists() and not self.db_file.exists()
+                self.db_file.parent.mkdir(parents=True, exist_ok=True)
+                connection = sqlite3.connect(self.db_file, check_same_thread=False)
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, response BLOB NOT NULL, "
+                                   "codec TEXT NOT NULL DEFAULT 'gzip')")
+                connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value BLOB NOT NULL)")
+                columns = [row[1] for row in connection.execute("PRAGMA table_info(cache)")]
+                if 'codec' not in columns:
+                    connection.execute("ALTER TABLE cache ADD COLUMN codec TEXT NOT NULL DEFAULT 'gzip'")
+                connection.commit()
+                self._connection = connection
+                self.load_meta()
+                if migrate:
+                    self.migrate_jsonl()
+            return self._connection
+
+    def load_meta(self):
+        meta = dict(self._connection.execute("SELECT name, value FROM meta"))
+        self.codec = meta.pop('codec', b'gzip').decode('ascii')
+        self.dictionaries = meta
+
+    def migrate_jsonl(self):
+        """Import the legacy JSONL log, later lines win as they did when the log was replayed."""
+        def rows():
             with self.cache_file.open("r") as f:
                 for line in f:
                     entry = json.loads(line)
-                    response = text_decompress(entry["response"])
-                    cache[entry["key"]] = json.loads(response) if self.loads else response
-        return cache
+                    # The log already holds gzip data, only the base64 wrapping is dropped
+                    yield entry["key"], base64.b64decode(entry["response"])
+
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO cache (key, response, codec) VALUES (?, ?, 'gzip')",
+                                        rows())
+            self.connection.commit()
+            entries = self.connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        print(f"Migrated {self.cache_file} to {self.db_file} ({entries} entries)")
+
+    def compress(self, text, codec):
+        data = text.encode('utf-8')
+        if codec == 'gzip':
+            return gzip.compress(data)
+        if codec == 'zdict':
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=self.dictionaries['zdict'])
+            return compressor.compress(data) + compressor.flush()
+        if codec == 'zstd':
+            zstandard = zstandard_module()
+            dict_data = self.dictionaries.get('zstd_dict')
+            dict_data = zstandard.ZstdCompressionDict(dict_data) if dict_data else None
+            return zstandard.ZstdCompressor(level=19, dict_data=dict_data).compress(data)
+        raise ValueError(f"Unknown cache codec: {codec}")
+
+    def decompress(self, data, codec):
+        if codec == 'gzip':
+            data = gzip.decompress(data)
+        elif codec == 'zdict':
+            decompressor = zlib.decompressobj(-15, zdict=self.dictionaries['zdict'])
+            data = decompressor.decompress(data) + decompressor.flush()
+        elif codec == 'zstd':
+            zstandard = zstandard_module()
+            dict_data = self.dictionaries.get('zstd_dict')
+            dict_data = zstandard.ZstdCompressionDict(dict_data) if dict_data else None
+            data = zstandard.ZstdDecompressor(dict_data=dict_data).decompress(data)
+        else:
+            raise ValueError(f"Unknown cache codec: {codec}")
+        return data.decode('utf-8')
+
+    def decode(self, data, codec='gzip'):
+        response = self.decompress(data, codec)
+        return json.loads(response) if self.loads else response
 
     def get_cached_response(self, cache_key):
-        return self.cache.get(cache_key)
+        with self.lock:
+            row = self.connection.execute("SELECT response, codec FROM cache WHERE key = ?", (cache_key,)).fetchone()
+        count(f"cache.{self.db_file.stem}.{'hit' if row else 'miss'}")
+        return self.decode(*row) if row else None
 
     def cache_response(self, cache_key, response):
-        self.cache[cache_key] = response
-        with self.cache_file.open("a") as f:
-            resp = json.dumps(response) if self.loads else response
-            entry = {"key": cache_key, "response": text_compress(resp)}
-            f.write(json.dumps(entry) + "\n")
+        resp = json.dumps(response) if self.loads else response
+        with self.lock:
+            # Connecting loads the codec and dictionaries chosen by the last compaction
+            connection = self.connection
+            data = self.compress(resp, self.codec)
+            connection.execute("INSERT OR REPLACE INTO cache (key, response, codec) VALUES (?, ?, ?)",
+                               (cache_key, data, self.codec))
+            connection.commit()
+
+    def keys(self):
+        with self.lock:
+            return [row[0] for row in self.connection.execute("SELECT key FROM cache ORDER BY rowid")]
+
+    def items(self):
+        """Yield (key, response) pairs, decoding lazily."""
+        for key in self.keys():
+            response = self.get_cached_response(key)
+            if response is not None:
+                yield key, response
+
+    def disk_size(self):
+        files = [self.db_file, Path(f"{self.db_file}-wal")]
+        return sum(f.stat().st_size for f in files if f.exists())
+
+    def timed_load(self):
+        """Seconds to decode every entry, the cost the old eager load paid at import time."""
+        start = time.perf_counter()
+        entries = sum(1 for _ in self.items())
+        return entries, time.perf_counter() - start
+
+    def train_dictionary(self, codec):
+        samples = [response for _, response in islice(self.raw_items(), DICT_SAMPLES)]
+        if codec == 'zdict':
+            return train_zdict(samples)
+        if codec == 'zstd':
+            zstandard = zstandard_module()
+            try:
+                return zstandard.train_dictionary(ZSTD_DICT_SIZE, [x.encode('utf-8') for x in samples]).as_bytes()
+            except zstandard.ZstdError:
+                # Too few samples to train on, plain zstd still beats gzip
+                return None
+        return None
+
+    def raw_items(self):
+        """Yield (key, text) pairs before the JSON decoding of loads caches."""
+        for key in self.keys():
+            with self.lock:
+                row = self.connection.execute("SELECT response, codec FROM cache WHERE key = ?", (key,)).fetchone()
+            if row:
+                yield key, self.decompress(*row)
+
+    def compact(self, codec=None):
+        """Re-encode every entry with codec (the current one by default) and reclaim the free pages.
+
+        Returns before/after sizes in bytes and full-load times in seconds.
+        """
+        codec = codec or self.codec
+        if codec not in CODECS:
+            raise ValueError(f"Unknown cache codec: {codec}")
+
+        with self.lock:
+            entries, load_before = self.timed_load()
+            size_before = self.disk_size()
+
+            dictionary = self.train_dictionary(codec)
+            rows = [(key, text) for key, text in self.raw_items()]
+            dictionaries = dict(self.dictionaries)
+            if codec == 'zdict':
+                dictionaries['zdict'] = dictionary
+            elif codec == 'zstd':
+                dictionaries.pop('zstd_dict', None)
+                if dictionary:
+                    dictionaries['zstd_dict'] = dictionary
+
+            # Compress with the new dictionaries before touching the database
+            self.dictionaries = dictionaries
+            encoded = [(self.compress(text, codec), codec, key) for key, text in rows]
+
+            connection = self.connection
+            connection.executemany("UPDATE cache SET response = ?, codec = ? WHERE key = ?", encoded)
+            connection.execute("DELETE FROM meta")
+            connection.executemany("INSERT INTO meta (name, value) VALUES (?, ?)",
+                                   [('codec', codec.encode('ascii'))] + list(dictionaries.items()))
+            connection.commit()
+            self.codec = codec
+            connection.execute("VACUUM")
+            connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+            _, load_after = self.timed_load()
+            size_after = self.disk_size()
+
+        return dict(entries=entries, size_before=size_before, size_after=size_after,
+                    load_before=load_before, load_after=load_after)
 
 
 HF_CACHE_FILE = Path("./.cache/hf_cache.jsonl")
-hf_cache_manager = CacheManager(HF_CACHE_FILE, False)
-
 HFP_CACHE_FILE = Path("./.cache/hfp_cache.jsonl")
-hfp_cache_manager = CacheManager(HFP_CACHE_FILE, False)
+# Completions keyed by arXiv id or date, superseded by the content-addressed caches in llm_cache.
+# Nothing writes them any more, they are kept so existing stores are still migrated and compacted.
+AFFILIATION_CACHE_FILE = Path("./.cache/affiliation_cache.jsonl")
+TLDR_CACHE_FILE = Path("./.cache/tldr_cache.jsonl")
+OVERVIEW_CACHE_FILE = Path("./.cache/overview_cache.jsonl")
+PAPER_REVIEW_CACHE_FILE = Path("./.cache/paper_review_cache.jsonl")
+PDF_TEXT_CACHE_FILE = Path("./.cache/pdf_text_cache.jsonl")
 
-TLDR_CACHE_FILE = Path("./.cache/affiliation_cache.jsonl")
-affiliation_cache_manager = CacheManager(TLDR_CACHE_FILE, False)
+# The managers are module attributes (from cache import hf_cache_manager) created on first access
+CACHE_FILES = {
+    'hf_cache_manager': HF_CACHE_FILE,
+    'hfp_cache_manager': HFP_CACHE_FILE,
+    'affiliation_cache_manager': AFFILIATION_CACHE_FILE,
+    'tldr_cache_manager': TLDR_CACHE_FILE,
+    'overview_cache_manager': OVERVIEW_CACHE_FILE,
+    'paper_review_cache_manager': PAPER_REVIEW_CACHE_FILE,
+    'pdf_text_cache_manager': PDF_TEXT_CACHE_FILE,
+}
+_managers = {}
+_managers_lock = threading.Lock()
 
-TLDR_CACHE_FILE = Path("./.cache/tldr_cache.jsonl")
-tldr_cache_manager = CacheManager(TLDR_CACHE_FILE, False)
 
-OVERVIEW_CACHE_FILE = Path("./.cache/overview_cache.jsonl")
-overview_cache_manager = CacheManager(TLDR_CACHE_FILE, False)
+def cache_manager(name):
+    with _managers_lock:
+        if name not in _managers:
+            _managers[name] = CacheManager(CACHE_FILES[name], False)
+        return _managers[name]
+
+
+def __getattr__(name):
+    if name in CACHE_FILES:
+        return cache_manager(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-PAPER_REVIEW_CACHE_FILE = Path("./.cache/paper_review_cache.jsonl")
-paper_review_cache_manager = CacheManager(PAPER_REVIEW_CACHE_FILE, False)
 
 def initialize():
     cache_dir().mkdir(exist_ok=True)
@@ -115,3 +347,53 @@ def initialize():
 
     Path('.data').mkdir(exist_ok=True)
 
+
+def all_managers():
+    from emergentmind import EMERGENT_CACHE
+    from llm_cache import all_caches
+
+    managers = [cache_manager(name) for name in CACHE_FILES] + [EMERGENT_CACHE] + all_caches()
+    # Visit each store once
+    unique = {}
+    for manager in managers:
+        unique.setdefault(manager.db_file, manager)
+    return list(unique.values())
+
+
+def import_legacy_completions():
+    """Re-key the completions of the arXiv id keyed stores by request, see llm.import_legacy_completions."""
+    legacy = [cache_manager(name) for name in ('tldr_cache_manager', 'affiliation_cache_manager')]
+    if any(manager.db_file.exists() or manager.cache_file.exists() for manager in legacy):
+        import llm
+        llm.import_legacy_completions()
+
+
+def migrate_all():
+    """One-shot migration of every known JSONL cache file to its SQLite store."""
+    for manager in all_managers():
+        if manager.cache_file.exists() and not manager.db_file.exists():
+            manager.connection
+        else:
+            print(f"Nothing to migrate for {manager.cache_file}")
+    import_legacy_completions()
+
+
+def compact_all(codec=None):
+    """Compact every cache store that exists on disk and print before/after sizes and load times."""
+    # Imported first, so the completion stores are compacted with the imported entries
+    import_legacy_completions()
+    print(f"{'cache':<36}{'entries':>8}{'MB before':>11}{'MB after':>10}{'load before':>13}{'load after':>12}")
+    for manager in all_managers():
+        if not manager.db_file.exists() and not manager.cache_file.exists():
+            continue
+        stats = manager.compact(codec)
+        print(f"{str(manager.db_file):<36}{stats['entries']:>8}"
+              f"{stats['size_before'] / 1e6:>11.2f}{stats['size_after'] / 1e6:>10.2f}"
+              f"{stats['load_before']:>12.2f}s{stats['load_after']:>11.2f}s")
+        if manager.cache_file.exists():
+            print(f"  legacy log {manager.cache_file} ({manager.cache_file.stat().st_size / 1e6:.2f} MB) "
+                  f"is no longer read and can be deleted")
+
+
+if __name__ == '__main__':
+    migrate_all()
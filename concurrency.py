@@ -0,0 +1,63 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+HUGGINGFACE_HOST = 'huggingface.co'
+ARXIV_HOST = 'arxiv.org'
+OPENAI_HOST = 'api.openai.com'
+EMERGENTMIND_HOST = 'www.emergentmind.com'
+
+# Maximum number of in-flight requests per host, shared by every worker thread
+HOST_LIMITS = {
+    HUGGINGFACE_HOST: 4,
+    ARXIV_HOST: 2,
+    OPENAI_HOST: 8,
+    EMERGENTMIND_HOST: 2,
+}
+DEFAULT_HOST_LIMIT = 4
+# Minimum seconds between the starts of two requests to a host, for sites we only scrape politely
+HOST_MIN_INTERVALS = {
+    EMERGENTMIND_HOST: 0.5,
+}
+
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+_next_start = {}
+_next_start_lock = threading.Lock()
+
+
+def host_semaphore(host):
+    with _host_semaphores_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(HOST_LIMITS.get(host, DEFAULT_HOST_LIMIT))
+        return _host_semaphores[host]
+
+
+def wait_turn(host):
+    interval = HOST_MIN_INTERVALS.get(host)
+    if not interval:
+        return
+    # Reserve the next start time under the lock, sleep outside it
+    with _next_start_lock:
+        now = time.monotonic()
+        start = max(now, _next_start.get(host, now))
+        _next_start[host] = start + interval
+    time.sleep(start - now)
+
+
+@contextmanager
+def host_slot(host):
+    with host_semaphore(host):
+        wait_turn(host)
+        yield
+
+
+def map_ordered(func, items, workers=1):
+    """Apply func to every item, using up to `workers` threads. Results keep the order of items."""
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+        return list(executor.map(func, items))
@@ -0,0 +1,137 @@
+import os
+from pathlib import Path
+
+from emergentmind import STAT_COLUMNS
+from utils import week_monday
+
+# Typed schema of the dataset, pandas dtypes: the sheet row columns, then the Emergent Mind stats,
+# nullable as they are written after the papers and are missing from backfilled days
+SCHEMA = {
+    'notes': 'string',
+    'pick': 'string',
+    'title': 'string',
+    'tldr': 'string',
+    'affiliations': 'string',
+    'upvote': 'int64',
+    'paperOfTheDay': 'string',
+    'abstract': 'string',
+    'date': 'string',
+    'arXiv': 'string',
+    'url': 'string',
+    'arXivPdf': 'string',
+    **{column: 'Int64' for column in STAT_COLUMNS},
+}
+KEY_COLUMN = 'arXiv'
+# Filled in after a week's papers are written, a rerun of the week keeps the stored values
+CARRIED_COLUMNS = ['notes', 'pick'] + STAT_COLUMNS
+
+
+def dataset_dir():
+    return Path('./.data/papers')
+
+
+def week_dir(monday):
+    return dataset_dir() / f"week={monday}"
+
+
+def day_file(day):
+    """Parquet file of a listed day, partitioned by week: week=<monday>/<day>.parquet."""
+    return week_dir(week_monday(day)) / f"{day}.parquet"
+
+
+def conform(frame, columns=None):
+    """The frame with the SCHEMA columns, or the given ones, in their dtypes. Missing columns are all null."""
+    columns = list(SCHEMA) if columns is None else columns
+    return frame.reindex(columns=columns).astype({column: SCHEMA[column] for column in columns})
+
+
+def to_frame(papers):
+    import pandas as pd
+
+    return conform(pd.DataFrame(list(papers), columns=list(SCHEMA)))
+
+
+def write_frame(path, frame):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Written aside then renamed, an interrupted run never leaves a partial day behind
+    partial = path.with_name(f".{path.name}.partial")
+    conform(frame).to_parquet(partial, index=False)
+    os.replace(partial, path)
+
+
+def write_day(day, papers):
+    """Write the day's papers, replacing the day's file. A day with no papers gets an empty file,
+    so it still counts as complete."""
+    write_frame(day_file(day), to_frame(papers))
+
+
+def write_week(monday, papers):
+    """Write a weekly run's papers, one file per day they were listed on.
+
+    Notes, picks and stats already stored for a paper are kept where the new rows leave them empty,
+    days without papers in this run keep their stored file.
+    """
+    frame = to_frame(papers)
+    stored = read(weeks=[monday], columns=[KEY_COLUMN] + CARRIED_COLUMNS).set_index(KEY_COLUMN)
+    stored = stored[~stored.index.duplicated()]
+    for column in CARRIED_COLUMNS if len(stored) else []:
+        empty = frame[column].astype('string').fillna('') == ''
+        previous = frame[KEY_COLUMN].map(stored[column]).astype(SCHEMA[column])
+        frame[column] = frame[column].mask(empty, previous)
+    for day, day_frame in frame.groupby('date', sort=True):
+        write_frame(day_file(day), day_frame)
+    return len(frame)
+
+
+def update(monday, values_by_key):
+    """Set columns of stored papers, values_by_key is {arXiv: {column: value}}. Returns the rows updated."""
+    import pandas as pd
+
+    updated = 0
+    for path in sorted(week_dir(monday).glob('*.parquet')):
+        frame = conform(pd.read_parquet(path))
+        rows = frame.index[frame[KEY_COLUMN].isin(list(values_by_key))]
+        if not len(rows):
+            continue
+        for row in rows:
+            for column, value in values_by_key[frame.at[row, KEY_COLUMN]].items():
+                frame.at[row, column] = pd.NA if value is None else value
+        write_frame(path, frame)
+        updated += len(rows)
+    return updated
+
+
+def weeks():
+    """Mondays of the stored weeks, oldest first."""
+    return sorted(path.name.split('=', 1)[1] for path in dataset_dir().glob('week=*') if path.is_dir())
+
+
+def completed_days():
+    return {path.stem for path in dataset_dir().glob('week=*/*.parquet')}
+
+
+def read(weeks=None, since=None, until=None, columns=None):
+    """Stored papers as a typed DataFrame with a 'week' column, optionally only some weeks, listing dates
+    from `since` to `until` included ('YYYY-MM-DD') and some columns. Only the matching files are read."""
+    import pandas as pd
+    import pyarrow.parquet as pq
+
+    columns = list(SCHEMA) if columns is None else [column for column in columns if column in SCHEMA]
+    frames = []
+    for path in sorted(dataset_dir().glob('week=*/*.parquet')):
+        week, day = path.parent.name.split('=', 1)[1], path.stem
+        if (weeks is not None and week not in weeks) or (since and day < since) or (until and day > until):
+            continue
+        # Only the wanted columns are read, files written before a column was added get it as nulls
+        stored = pq.read_schema(path).names
+        frame = pd.read_parquet(path, columns=[column for column in columns if column in stored])
+        frames.append(conform(frame, columns).assign(week=week))
+
+    if not frames:
+        return conform(pd.DataFrame(), columns).assign(week=pd.Series(dtype='string'))
+    return pd.concat(frames, ignore_index=True).astype({'week': 'string'})
+
+
+def records(frame):
+    """Rows as dicts of plain Python values, nulls as None."""
+    return frame.astype(object).where(frame.notna(), None).to_dict('records')
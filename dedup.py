@@ -0,0 +1,163 @@
+import re
+from collections import defaultdict
+
+import numpy as np
+
+# MinHash signatures of NUM_PERMUTATIONS values, banded for LSH into BANDS bands of ROWS values.
+# Pairs sharing a band are compared, those whose estimated Jaccard similarity of word
+# shingles reaches NEAR_DUPLICATE_THRESHOLD are near-duplicates.
+NUM_PERMUTATIONS = 64
+BANDS = 16
+ROWS = NUM_PERMUTATIONS // BANDS
+SHINGLE_WORDS = 3
+NEAR_DUPLICATE_THRESHOLD = 0.8
+# Mersenne prime modulus of the hash permutations, small enough that a * h + b fits in 64 bits
+PRIME = (1 << 31) - 1
+# Shingles hashed per NumPy pass, bounds memory on archive-wide runs
+SHINGLE_BLOCK = 1 << 18
+SEED = 1
+
+
+def arxiv_id(paper):
+    """arXiv id without version, 'https://arxiv.org/abs/2408.08072v2' -> '2408.08072'."""
+    return re.sub(r'v\d+$', '', paper['arXiv'].rstrip('/').split('/')[-1])
+
+
+def merge_into(kept, duplicate):
+    """Keep the highest upvote count and the earliest paper-of-the-day date of the two."""
+    kept['upvote'] = max(kept['upvote'], duplicate['upvote'])
+    days = [day for day in (kept['paperOfTheDay'], duplicate['paperOfTheDay']) if day]
+    kept['paperOfTheDay'] = min(days) if days else None
+
+
+def dedup_key(paper, aliases=None):
+    """Key shared by a paper and its duplicates: its arXiv id, or that of the paper kept in its place."""
+    key = arxiv_id(paper)
+    return (aliases or {}).get(key, key)
+
+
+def exact_dedup(papers):
+    """One paper per arXiv id, the first listing is kept. Returns (papers, merged count)."""
+    by_id = {}
+    for paper in papers:
+        key = arxiv_id(paper)
+        if key in by_id:
+            merge_into(by_id[key], paper)
+        else:
+            by_id[key] = dict(paper)
+    return list(by_id.values()), len(papers) - len(by_id)
+
+
+def shingle_hashes(texts):
+    """(hashes, document offsets) of the word shingles of every text, as flat uint64 arrays."""
+    vocabulary = {}
+    hashes, offsets = [], [0]
+    for text in texts:
+        words = np.array([vocabulary.setdefault(word, len(vocabulary)) for word in re.findall(r'\w+', text.lower())],
+                         dtype=np.uint64)
+        if len(words) >= SHINGLE_WORDS:
+            # Combine consecutive word ids into one value per shingle, then reduce below the prime
+            shingles = np.zeros(len(words) - SHINGLE_WORDS + 1, dtype=np.uint64)
+            for i in range(SHINGLE_WORDS):
+                shingles = shingles * np.uint64(1_000_003) + words[i:len(words) - SHINGLE_WORDS + 1 + i]
+        else:
+            shingles = words
+        shingles = np.unique(shingles % np.uint64(PRIME))
+        hashes.append(shingles)
+        offsets.append(offsets[-1] + len(shingles))
+    return (np.concatenate(hashes) if hashes else np.empty(0, dtype=np.uint64)), np.array(offsets)
+
+
+def minhash_signatures(texts):
+    """NUM_PERMUTATIONS x len(texts) MinHash signatures, computed block by block over all shingles."""
+    hashes, offsets = shingle_hashes(texts)
+    rng = np.random.default_rng(SEED)
+    a = rng.integers(1, PRIME, NUM_PERMUTATIONS, dtype=np.uint64)[:, None]
+    b = rng.integers(0, PRIME, NUM_PERMUTATIONS, dtype=np.uint64)[:, None]
+
+    signatures = np.full((NUM_PERMUTATIONS, len(texts)), PRIME, dtype=np.uint64)
+    documents = np.repeat(np.arange(len(texts)), np.diff(offsets))
+    for start in range(0, len(hashes), SHINGLE_BLOCK):
+        block = (a * hashes[start:start + SHINGLE_BLOCK] + b) % np.uint64(PRIME)
+        block_documents = documents[start:start + SHINGLE_BLOCK]
+        # Minimum per document over the block's shingles, documents are contiguous runs
+        starts = np.flatnonzero(np.r_[True, block_documents[1:] != block_documents[:-1]])
+        minima = np.minimum.reduceat(block, starts, axis=1)
+        columns = block_documents[starts]
+        signatures[:, columns] = np.minimum(signatures[:, columns], minima)
+    return signatures
+
+
+def near_duplicate_pairs(signatures, threshold=NEAR_DUPLICATE_THRESHOLD):
+    """(i, j, similarity) for documents whose signatures agree on at least `threshold` of the values."""
+    buckets = defaultdict(list)
+    for band in range(BANDS):
+        rows = signatures[band * ROWS:(band + 1) * ROWS]
+        for document, key in enumerate(map(bytes, rows.T.copy())):
+            buckets[band, key].append(document)
+
+    candidates = {(i, j) for documents in buckets.values() if len(documents) > 1
+                  for n, i in enumerate(documents) for j in documents[n + 1:]}
+    if not candidates:
+        return []
+    first, second = np.array(sorted(candidates)).T
+    similarity = (signatures[:, first] == signatures[:, second]).mean(axis=0)
+    keep = similarity >= threshold
+    return list(zip(first[keep].tolist(), second[keep].tolist(), similarity[keep].tolist()))
+
+
+def near_dedup(papers, threshold=NEAR_DUPLICATE_THRESHOLD):
+    """Collapse groups of near-identical title + abstract, keeping the most upvoted paper of each.
+
+    Returns (papers, [(kept arXiv id, dropped arXiv id, similarity)]).
+    """
+    texts = [f"{paper['title']} {paper['abstract']}" for paper in papers]
+    pairs = near_duplicate_pairs(minhash_signatures(texts), threshold)
+
+    # Union-find over the pairs, every group is represented by its most upvoted paper
+    parent = list(range(len(papers)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j, _ in pairs:
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            if (papers[root_j]['upvote'], -root_j) > (papers[root_i]['upvote'], -root_i):
+                root_i, root_j = root_j, root_i
+            parent[root_j] = root_i
+
+    similarity = {}
+    for i, j, score in pairs:
+        similarity[j] = similarity[i] = max(score, similarity.get(i, 0))
+    kept, dropped = {}, []
+    for i, paper in enumerate(papers):
+        root = find(i)
+        if root == i:
+            kept[i] = dict(paper)
+    for i, paper in enumerate(papers):
+        root = find(i)
+        if root != i:
+            merge_into(kept[root], paper)
+            dropped.append((arxiv_id(papers[root]), arxiv_id(paper), similarity[i]))
+    return [kept[i] for i in sorted(kept)], dropped
+
+
+def dedup_papers(papers, threshold=NEAR_DUPLICATE_THRESHOLD, aliases=None):
+    """Exact dedup by arXiv id, then near-duplicate dedup. Prints what was merged and dropped.
+
+    A dict passed as aliases gets the arXiv id of every dropped near-duplicate mapped to the kept one's.
+    """
+    papers, merged = exact_dedup(papers)
+    papers, dropped = near_dedup(papers, threshold)
+    if aliases is not None:
+        aliases.update((duplicate, kept) for kept, duplicate, _ in dropped)
+    if merged or dropped:
+        print(f"Dedup: {merged} repeated listings merged, {len(dropped)} near-duplicates dropped, "
+              f"{len(papers)} papers left")
+    for kept, duplicate, score in dropped:
+        print(f"  {duplicate} dropped as a near-duplicate of {kept} (similarity {score:.2f})")
+    return papers
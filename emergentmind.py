@@ -1,9 +1,10 @@
 from marshal import loads
 from pathlib import Path
 import re
-import requests
 
+import http_client
 from cache import CacheManager
+from concurrency import map_ordered, HOST_LIMITS, EMERGENTMIND_HOST
 
 def extract_value(input_string, key):
     pattern = rf'"{key}":\s*([^"]*),'
@@ -26,18 +27,50 @@ def paper_url(arxiv_id):
 EMERGENT_BASE_URL = 'https://www.emergentmind.com/papers/'
 EMERGENT_CACHE = CacheManager(Path('.cache/emergent.jsonl'), loads)
 
+STAT_NAMES = ["twitter_likes_count", "reddit_points_count", "hacker_news_points_count", "youtube_paper_mentions_count",
+              "github_repos_count", "github_stars_count", "github_pages_count"]
+# Sheet columns of the stats, in STAT_NAMES order
+STAT_COLUMNS = [python_to_java_name(x) for x in STAT_NAMES]
+# Every stat in one scan of the page, the page escapes its JSON quotes as &quot;
+STATS_PATTERN = re.compile(rf'(?:"|&quot;)({"|".join(STAT_NAMES)})(?:"|&quot;):\s*(-?\d+)')
+
+
+def parse_stats(content):
+    """Stats of a paper page, -1 for those not found. The first occurrence of a name wins."""
+    found = {}
+    for match in STATS_PATTERN.finditer(content):
+        found.setdefault(match.group(1), int(match.group(2)))
+        if len(found) == len(STAT_NAMES):
+            break
+    return {python_to_java_name(x): found.get(x, -1) for x in STAT_NAMES}
+
+
 def get_stats(arxiv_id):
     stats = EMERGENT_CACHE.get_cached_response(arxiv_id)
     if stats:
         return stats
 
-    content = (requests.get(paper_url(arxiv_id))).text.replace('&quot;', '"')
-    stat_names = ["twitter_likes_count", "reddit_points_count", "hacker_news_points_count", "youtube_paper_mentions_count", "github_repos_count", "github_stars_count", "github_pages_count"]
-    stats = { python_to_java_name(x): extract_value(content, x) for x in stat_names}
+    stats = parse_stats(http_client.get(paper_url(arxiv_id)).text)
     EMERGENT_CACHE.cache_response(arxiv_id, stats)
     return stats
 
 
+def fetch_all_stats(arxiv_urls, workers=HOST_LIMITS[EMERGENTMIND_HOST]):
+    """{arXiv URL: stats} for a week of papers, fetched concurrently within the site's rate limit.
+
+    Papers whose page cannot be fetched are left out.
+    """
+    def fetch(arxiv_url):
+        try:
+            return get_stats(arxiv_url.split('/')[-1])
+        except Exception as e:
+            print(f"No Emergent Mind stats for {arxiv_url}: {e!r}")
+            return None
+
+    all_stats = map_ordered(fetch, arxiv_urls, workers=workers)
+    return {arxiv_url: stats for arxiv_url, stats in zip(arxiv_urls, all_stats) if stats is not None}
+
+
 
 # %%
 
@@ -1,13 +1,20 @@
+import json
 import os
+import threading
+from datetime import datetime, timedelta
+
+import httplib2
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from google.oauth2 import service_account
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 
-from google.cloud import service_usage_v1
 from googleapiclient.errors import HttpError
 
+from dedup import dedup_key
+from tracing import count, traced
+
 PROJECT_ID = 'paper-review-harmonious'
 
 # If modifying these scopes, delete the file token.json.
@@ -15,10 +22,19 @@ SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 CREDENTIALS_FILE = 'google_oauth_credentials.json'
 TOKEN_FILE = 'token.json'
 SERVICE_ACCOUNT_FILE = 'service_account.json'
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+HTTP_TIMEOUT = 60
+
+_creds = None
+_service = None
+_auth_lock = threading.RLock()
 
 
 # cmdline: gcloud services enable sheets.googleapis.com
 def enable_sheets_api(project_id):
+    # Heavy and rarely needed, imported on use like the OAuth flow below
+    from google.cloud import service_usage_v1
+
     client = service_usage_v1.ServiceUsageClient()
     service_name = f"projects/{project_id}/services/sheets.googleapis.com"
     request = service_usage_v1.EnableServiceRequest(
@@ -34,23 +50,230 @@ def enable_sheets_api(project_id):
     return response
 
 
+# Google recommends keeping request payloads under 2 MB
+MAX_REQUEST_BYTES = 2_000_000
+# Columns an incremental sync refreshes on rows already in the sheet, reviewer columns are never written
+SYNCED_COLUMNS = ['upvote', 'paperOfTheDay']
+
+
+def repeat_format_request(sheet_id, col_index, start_row, end_row, user_entered_format):
+    return {
+        "repeatCell": {
+            "range": {
+                "sheetId": sheet_id,
+                "startRowIndex": start_row,
+                "endRowIndex": end_row,
+                "startColumnIndex": col_index,
+                "endColumnIndex": col_index + 1
+            },
+            "cell": {"userEnteredFormat": user_entered_format},
+            "fields": ','.join(f"userEnteredFormat.{key}" for key in user_entered_format)
+        }
+    }
+
+
+def cell_value(value):
+    """ExtendedValue of a RAW value, None leaves the cell empty."""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, (int, float)):
+        return {'numberValue': value}
+    return {'stringValue': str(value)}
+
+
+def payload_size(payload):
+    return len(json.dumps(payload))
+
+
+def chunk_rows(row_data, max_bytes):
+    """Split row_data into consecutive chunks whose serialized size stays under max_bytes."""
+    chunks, chunk, size = [], [], 0
+    for row in row_data:
+        row_size = payload_size(row) + 1
+        if chunk and size + row_size > max_bytes:
+            chunks.append(chunk)
+            chunk, size = [], 0
+        chunk.append(row)
+        size += row_size
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
 class GSheet:
-    def __init__(self, papers, spreadsheet_name):
+    """Builds the weekly review spreadsheet.
+
+    With deferred=True, create_spreadsheet, insert_clickable_urls, insert_notes, format_columns
+    (wrap_text_in_columns) and set_cell_dims only record their changes, and commit() sends them as one
+    spreadsheets.create carrying the sheet data, plus one batchUpdate with the column formats and any
+    rows that do not fit in the create payload.
+    """
+
+    def __init__(self, papers, spreadsheet_name, service=None, deferred=False):
         self.abstracts = [paper['abstract'] for paper in papers]
         for paper in papers:
             del paper['abstract']
 
         self.papers = papers
         self.spreadsheet_name = spreadsheet_name
-        self.creds = authenticate()
-        self.service = build('sheets', 'v4', credentials=self.creds)
+        self.service = service or get_service()
         self.spreadsheet_id = None
         self.column_names = list(papers[0].keys())
         self.paper_values = [list(paper.values()) for paper in papers]
         self.titles = [paper['title'] for paper in papers]
         self.pdf_urls = [paper['arXivPdf'] for paper in papers]
 
+        self.deferred = deferred
+        self.sheet_title = "Sheet1"
+        self.cells = {}
+        self.format_requests = []
+        self.column_pixels = {}
+        self.row_pixels = {}
+
+    def cell(self, row, col):
+        return self.cells.setdefault((row, col), {})
+
+    @traced('sheets.commit')
+    def commit(self, sheet_id=0, max_request_bytes=MAX_REQUEST_BYTES):
+        """Send everything recorded in deferred mode, returns the new spreadsheet id."""
+        num_rows = len(self.papers) + 1
+        num_cols = len(self.column_names)
+        row_data = [{'values': [self.cells.get((row, col), {}) for col in range(num_cols)]}
+                    for row in range(num_rows)]
+
+        grid = {'startRow': 0, 'startColumn': 0}
+        if self.column_pixels:
+            grid['columnMetadata'] = [{'pixelSize': self.column_pixels[col]} if col in self.column_pixels else {}
+                                      for col in range(num_cols)]
+        if self.row_pixels:
+            grid['rowMetadata'] = [{'pixelSize': self.row_pixels[row]} if row in self.row_pixels else {}
+                                   for row in range(num_rows)]
+
+        body = {
+            'properties': {'title': self.spreadsheet_name},
+            'sheets': [{
+                'properties': {
+                    'sheetId': sheet_id,
+                    'title': self.sheet_title,
+                    'gridProperties': {'rowCount': max(num_rows, 1000), 'columnCount': max(num_cols, 26)},
+                },
+                'data': [grid],
+            }],
+        }
+
+        # Rows that would push the create request over the limit are appended afterwards
+        room = max_request_bytes - payload_size(body)
+        chunks = chunk_rows(row_data, room)
+        grid['rowData'] = chunks[0] if chunks else []
+
+        count('sheets.bytes_sent', payload_size(body))
+        spreadsheet = self.service.spreadsheets().create(body=body, fields='spreadsheetId').execute()
+        self.spreadsheet_id = spreadsheet['spreadsheetId']
+
+        requests = [{'appendCells': {'sheetId': sheet_id, 'rows': chunk, 'fields': '*'}} for chunk in chunks[1:]]
+        # Formats go last, appendCells with fields '*' would reset the format of the rows it writes
+        self.batch_update(requests + self.format_requests, max_request_bytes)
+        return self.spreadsheet_id
+
+    @traced('sheets.batch_update')
+    def batch_update(self, requests, max_request_bytes=MAX_REQUEST_BYTES):
+        """Send requests in as few batchUpdate calls as the payload limit allows."""
+        batch, size = [], 0
+        for request in requests:
+            request_size = payload_size(request) + 1
+            if batch and size + request_size > max_request_bytes:
+                count('sheets.bytes_sent', size)
+                self.service.spreadsheets().batchUpdate(spreadsheetId=self.spreadsheet_id,
+                                                        body={'requests': batch}).execute()
+                batch, size = [], 0
+            batch.append(request)
+            size += request_size
+        if batch:
+            count('sheets.bytes_sent', size)
+            self.service.spreadsheets().batchUpdate(spreadsheetId=self.spreadsheet_id,
+                                                    body={'requests': batch}).execute()
+
+    @traced('sheets.sync')
+    def sync(self, spreadsheet_id, wrap_columns=(), aliases=None, sheet_id=0, sheet_title="Sheet1"):
+        """Bring an existing sheet up to date with self.papers, matched on dedup.dedup_key: the arXiv id,
+        through `aliases` for rows holding a near-duplicate that the week's dedup dropped for another copy.
+
+        New papers are appended at the bottom (with their link, note and wrap format) and only the
+        SYNCED_COLUMNS cells that changed are rewritten, all in one batchUpdate. Rows are never
+        reordered or removed, so reviewer notes and picks stay where they are.
+        Returns (appended, updated) counts.
+        """
+        self.spreadsheet_id = spreadsheet_id
+        headers, rows = GSheetReader(spreadsheet_id, self.service).read_values(sheet_title)
+        arxiv_col = headers.index('arXiv')
+        existing = {dedup_key(dict(arXiv=row[arxiv_col]), aliases): (i + 1, row)
+                    for i, row in enumerate(rows) if len(row) > arxiv_col}
+
+        requests = []
+        new_rows = []
+        for paper, abstract in zip(self.papers, self.abstracts):
+            key = dedup_key(paper, aliases)
+            if key not in existing:
+                new_rows.append(self.row_data(paper, abstract, headers))
+                continue
+            row_index, row = existing[key]
+            for column in SYNCED_COLUMNS:
+                col_index = headers.index(column)
+                current = row[col_index] if col_index < len(row) else ''
+                value = paper[column]
+                if current == ('' if value is None else str(value)):
+                    continue
+                requests.append({
+                    'updateCells': {
+                        'range': {
+                            'sheetId': sheet_id,
+                            'startRowIndex': row_index,
+                            'endRowIndex': row_index + 1,
+                            'startColumnIndex': col_index,
+                            'endColumnIndex': col_index + 1
+                        },
+                        'rows': [{'values': [{'userEnteredValue': cell_value(value)} if value is not None else {}]}],
+                        'fields': 'userEnteredValue'
+                    }
+                })
+        updated = len(requests)
+
+        if new_rows:
+            requests.append({'appendCells': {'sheetId': sheet_id, 'rows': new_rows, 'fields': '*'}})
+            start_row = len(rows) + 1
+            for col in wrap_columns:
+                requests.append(repeat_format_request(sheet_id, headers.index(col), start_row,
+                                                      start_row + len(new_rows), {"wrapStrategy": "WRAP"}))
+
+        self.batch_update(requests)
+        return len(new_rows), updated
+
+    def row_data(self, paper, abstract, headers):
+        """RowData of a paper in the sheet's column order, as create_spreadsheet and friends would write it."""
+        values = []
+        for header in headers:
+            cell = {}
+            if header == 'title':
+                cell['userEnteredValue'] = {'formulaValue': f'=HYPERLINK("{paper["arXivPdf"]}", "{paper["title"]}")'}
+            elif cell_value(paper.get(header)) is not None:
+                cell['userEnteredValue'] = cell_value(paper.get(header))
+            if header == 'tldr':
+                cell['note'] = abstract
+            values.append(cell)
+        return {'values': values}
+
     def create_spreadsheet(self, sheet_title="Sheet1"):
+        if self.deferred:
+            self.sheet_title = sheet_title
+            for row, values in enumerate([self.column_names] + self.paper_values):
+                for col, value in enumerate(values):
+                    user_entered_value = cell_value(value)
+                    if user_entered_value is not None:
+                        self.cell(row, col)['userEnteredValue'] = user_entered_value
+            return None
+
         spreadsheet = self.service.spreadsheets().create(body={
             'properties': {'title': self.spreadsheet_name}
         }).execute()
@@ -72,6 +295,10 @@ class GSheet:
         requests = []
         column_index = self.column_names.index('title')
         for i, (title, url) in enumerate(zip(titles, urls)):
+            if self.deferred:
+                self.cell(i + 1, column_index)['userEnteredValue'] = {
+                    'formulaValue': f'=HYPERLINK("{url}", "{title}")'}
+                continue
             requests.append({
                 'updateCells': {
                     'range': {
@@ -90,42 +317,39 @@ class GSheet:
                 }
             })
 
+        if self.deferred:
+            return
         body = {'requests': requests}
         self.service.spreadsheets().batchUpdate(spreadsheetId=self.spreadsheet_id, body=body).execute()
 
-    def wrap_text_in_columns(self, columns_to_wrap, strategy, sheet_id=0):
-        num_rows = len(self.papers)
-
-        requests = []
-        for col in columns_to_wrap:
-            col_index = self.column_names.index(col)
-            print(f"Wrapping text in {col} with index {col_index}")
-            requests.append({
-                "updateCells": {
-                    "range": {
-                        "sheetId": sheet_id,
-                        "startRowIndex": 1,
-                        "endRowIndex": num_rows + 1,
-                        "startColumnIndex": col_index,
-                        "endColumnIndex": col_index + 1
-                    },
-                    "rows": [{"values": [{"userEnteredFormat": {"wrapStrategy": f"{strategy}"}}]} for _ in
-                             range(num_rows)],
-                    "fields": "userEnteredFormat.wrapStrategy"
-                }
-            })
+    def format_columns(self, columns, user_entered_format, sheet_id=0):
+        """Apply one format to the paper rows of each column, one repeatCell per column whatever the row count."""
+        requests = [repeat_format_request(sheet_id, self.column_names.index(col), 1, len(self.papers) + 1,
+                                          user_entered_format)
+                    for col in columns]
 
+        if self.deferred:
+            self.format_requests.extend(requests)
+            return
         body = {
             'requests': requests
         }
 
         self.service.spreadsheets().batchUpdate(spreadsheetId=self.spreadsheet_id, body=body).execute()
 
+    def wrap_text_in_columns(self, columns_to_wrap, strategy, sheet_id=0):
+        for col in columns_to_wrap:
+            print(f"Wrapping text in {col} with index {self.column_names.index(col)}")
+        self.format_columns(columns_to_wrap, {"wrapStrategy": f"{strategy}"}, sheet_id)
+
     def set_cell_dims(self, column_list, pixels_list, dim, sheet_id=0):
         requests = []
         for column, pixels in zip(column_list, pixels_list):
             col_index = self.column_names.index(column)
             print(f"Setting dimension {dim} for column {column}, index {col_index} to {pixels} pixels")
+            if self.deferred:
+                (self.column_pixels if dim == 'COLUMNS' else self.row_pixels)[col_index] = pixels
+                continue
             requests.append({
                 'updateDimensionProperties': {
                     'range': {
@@ -141,6 +365,8 @@ class GSheet:
                 }
             })
 
+        if self.deferred:
+            return
         body = {
             'requests': requests
         }
@@ -151,6 +377,9 @@ class GSheet:
         requests = []
         col_index = self.column_names.index(col)
         for i, note in enumerate(notes):
+            if self.deferred:
+                self.cell(i + 1, col_index)['note'] = note
+                continue
             requests.append({
                 'updateCells': {
                     'range': {
@@ -173,6 +402,8 @@ class GSheet:
                 }
             })
 
+        if self.deferred:
+            return
         body = {
             'requests': requests
         }
@@ -219,37 +450,194 @@ class GSheet:
 
 
 class GSheetReader:
-    def __init__(self, spreadsheet_id):
+    def __init__(self, spreadsheet_id, service=None):
         self.spreadsheet_id = spreadsheet_id
-        self.creds = authenticate()
-        self.service = build('sheets', 'v4', credentials=self.creds)
+        self.service = service or get_service()
 
-    def read_sheet(self, sheet_name='Sheet1'):
+    @traced('sheets.read_values')
+    def read_values(self, sheet_name='Sheet1'):
+        """(headers, rows) as lists of displayed values, trailing empty cells are omitted by the API."""
         result = self.service.spreadsheets().values().get(
             spreadsheetId=self.spreadsheet_id,
             range=sheet_name
         ).execute()
         data = result.get('values', [])
 
-        if not data or len(data) < 2:
-            return []
+        if not data:
+            return [], []
+        return data[0], data[1:]
 
-        headers = data[0]
-        return [dict(zip(headers, row)) for row in data[1:]]
+    def read_sheet(self, sheet_name='Sheet1'):
+        headers, rows = self.read_values(sheet_name)
+        return [dict(zip(headers, row)) for row in rows]
 
-def authenticate():
-    creds = None
-    if os.path.exists(TOKEN_FILE):
-        creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
+    @traced('sheets.batch_get')
+    def batch_get(self, ranges):
+        result = self.service.spreadsheets().values().batchGet(
+            spreadsheetId=self.spreadsheet_id,
+            ranges=ranges
+        ).execute()
+        return [value_range.get('values', []) for value_range in result.get('valueRanges', [])]
+
+    def read_rows(self, columns, filter_columns=(), where=None, key_column='arXiv', page_size=500,
+                  sheet_name='Sheet1'):
+        """Yield dicts of `columns` (plus 'row_index', the sheet row number) for rows passing the filter.
+
+        The key and filter columns are read page by page with values.batchGet; `where` gets a dict of
+        the filter columns and defaults to "any of them is non-empty". The projected columns are then
+        fetched only for the contiguous runs of rows that survived.
+        """
+        headers = self.batch_get([f"{sheet_name}!1:1"])[0]
+        headers = headers[0] if headers else []
+        columns = [column for column in columns if column in headers]
+        filter_columns = [column for column in filter_columns if column in headers]
+        if where is None:
+            where = lambda row: not filter_columns or any(row.values())
+
+        def column_range(column, first_row, last_row):
+            letter = column_letter(headers.index(column))
+            return f"{sheet_name}!{letter}{first_row}:{letter}{last_row}"
+
+        first_row = 2
+        while True:
+            last_row = first_row + page_size - 1
+            pages = self.batch_get([column_range(column, first_row, last_row)
+                                    for column in [key_column] + filter_columns])
+            keys = pages[0]
+
+            survivors = []
+            for offset in range(len(keys)):
+                row = {column: cell_at(page, offset) for column, page in zip(filter_columns, pages[1:])}
+                if where(row):
+                    survivors.append(first_row + offset)
+
+            runs = contiguous_runs(survivors)
+            if runs and columns:
+                # One request for every run of the page, ranges come back in request order
+                values = self.batch_get([column_range(column, run[0], run[-1]) for run in runs for column in columns])
+                for i, run in enumerate(runs):
+                    run_values = values[i * len(columns):(i + 1) * len(columns)]
+                    for offset, row_index in enumerate(run):
+                        row = {column: cell_at(page, offset) for column, page in zip(columns, run_values)}
+                        row['row_index'] = row_index
+                        yield row
+
+            if len(keys) < page_size:
+                return
+            first_row = last_row + 1
+
+
+@traced('sheets.write_columns')
+def write_columns(spreadsheet_id, columns, values_by_key, key_column='arXiv', service=None, sheet_id=0,
+                  sheet_title='Sheet1'):
+    """Fill `columns` for the rows whose key is in values_by_key ({key: {column: value}}) in one batchUpdate.
+
+    Columns missing from the header row are added after the last one. Rows without values keep
+    their cells. Returns the number of rows written.
+    """
+    service = service or get_service()
+    reader = GSheetReader(spreadsheet_id, service)
+    headers = reader.batch_get([f"{sheet_title}!1:1"])[0]
+    headers = headers[0] if headers else []
+    key_letter = column_letter(headers.index(key_column))
+    keys = reader.batch_get([f"{sheet_title}!{key_letter}2:{key_letter}"])[0]
+    rows = {row_index: values_by_key[cell_at(keys, row_index - 1)]
+            for row_index in range(1, len(keys) + 1) if cell_at(keys, row_index - 1) in values_by_key}
+
+    requests = []
+    for column in columns:
+        if column not in headers:
+            headers.append(column)
+            requests.append({'updateCells': {
+                'range': {'sheetId': sheet_id, 'startRowIndex': 0, 'endRowIndex': 1,
+                          'startColumnIndex': len(headers) - 1, 'endColumnIndex': len(headers)},
+                'rows': [{'values': [{'userEnteredValue': cell_value(column)}]}],
+                'fields': 'userEnteredValue'
+            }})
+        col_index = headers.index(column)
+        for run in contiguous_runs(sorted(rows)):
+            requests.append({'updateCells': {
+                'range': {'sheetId': sheet_id, 'startRowIndex': run[0], 'endRowIndex': run[-1] + 1,
+                          'startColumnIndex': col_index, 'endColumnIndex': col_index + 1},
+                'rows': [{'values': [{'userEnteredValue': cell_value(rows[row_index].get(column))}
+                                     if rows[row_index].get(column) is not None else {}]} for row_index in run],
+                'fields': 'userEnteredValue'
+            }})
+
+    if requests:
+        count('sheets.bytes_sent', payload_size({'requests': requests}))
+        service.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body={'requests': requests}).execute()
+    return len(rows)
+
+
+def column_letter(index):
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def cell_at(column_values, offset):
+    """Value at offset in a single-column range, the API drops trailing empty cells."""
+    return column_values[offset][0] if offset < len(column_values) and column_values[offset] else ''
+
+
+def contiguous_runs(row_indexes):
+    runs = []
+    for row_index in row_indexes:
+        if runs and runs[-1][-1] == row_index - 1:
+            runs[-1].append(row_index)
         else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                CREDENTIALS_FILE, SCOPES)
-            creds = flow.run_local_server(port=0)
-        with open(TOKEN_FILE, 'w') as token:
-            token.write(creds.to_json())
-    return creds
-
-# %%
\ No newline at end of file
+            runs.append([row_index])
+    return runs
+
+
+def save_token(creds):
+    with open(TOKEN_FILE, 'w') as token:
+        token.write(creds.to_json())
+
+
+def refresh_if_expiring(creds):
+    """Refresh ahead of expiry, so a long run never sends a request with a token about to lapse."""
+    if creds.refresh_token and creds.expiry and creds.expiry - datetime.utcnow() < TOKEN_REFRESH_MARGIN:
+        creds.refresh(Request())
+        save_token(creds)
+
+
+def authenticate():
+    """Process-wide credentials, token.json is read (and the OAuth flow run) at most once."""
+    global _creds
+    with _auth_lock:
+        if _creds is None:
+            creds = None
+            if os.path.exists(TOKEN_FILE):
+                creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+            if not creds or not creds.valid:
+                if creds and creds.expired and creds.refresh_token:
+                    creds.refresh(Request())
+                else:
+                    from google_auth_oauthlib.flow import InstalledAppFlow
+                    flow = InstalledAppFlow.from_client_secrets_file(
+                        CREDENTIALS_FILE, SCOPES)
+                    creds = flow.run_local_server(port=0)
+                save_token(creds)
+            _creds = creds
+        refresh_if_expiring(_creds)
+        return _creds
+
+
+def get_service():
+    """Process-wide Sheets service shared by GSheet and GSheetReader.
+
+    It is built once from the discovery document bundled with google-api-python-client (no network),
+    over one authorized httplib2 transport that also refreshes the token on a 401.
+    """
+    global _service
+    creds = authenticate()
+    with _auth_lock:
+        if _service is None:
+            authorized_http = AuthorizedHttp(creds, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+            _service = build('sheets', 'v4', http=authorized_http, static_discovery=True, cache_discovery=False)
+        return _service
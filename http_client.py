@@ -0,0 +1,101 @@
+import os
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from concurrency import host_slot, HOST_LIMITS, DEFAULT_HOST_LIMIT
+from tracing import count, span
+
+# Seconds, overridable from the environment (or .env)
+CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 10))
+READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 60))
+RETRIES = int(os.environ.get('HTTP_RETRIES', 5))
+# Exponential backoff: BACKOFF_FACTOR * 2 ** retry, plus up to BACKOFF_JITTER seconds of random jitter
+BACKOFF_FACTOR = 1.0
+BACKOFF_JITTER = 1.0
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+USER_AGENT = 'papers (+https://github.com/AI2Incubator/papers)'
+
+_session = None
+_session_lock = threading.Lock()
+
+_stats = defaultdict(lambda: dict(requests=0, retries=0, errors=0, bytes=0, seconds=0.0, max_seconds=0.0))
+_stats_lock = threading.Lock()
+
+
+def session():
+    """The process-wide session, keep-alive connections are pooled per host."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=RETRIES,
+                backoff_factor=BACKOFF_FACTOR,
+                backoff_jitter=BACKOFF_JITTER,
+                status_forcelist=RETRY_STATUSES,
+                respect_retry_after_header=True,
+            )
+            # Workers never hold more connections to a host than its concurrency limit
+            pool_size = max(list(HOST_LIMITS.values()) + [DEFAULT_HOST_LIMIT])
+            adapter = HTTPAdapter(pool_connections=len(HOST_LIMITS) + 1, pool_maxsize=pool_size, max_retries=retry)
+            _session = requests.Session()
+            _session.headers['User-Agent'] = USER_AGENT
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def record(host, seconds, num_bytes=0, retries=0, error=False):
+    with _stats_lock:
+        host_stats = _stats[host]
+        host_stats['requests'] += 1
+        host_stats['retries'] += retries
+        host_stats['errors'] += int(error)
+        host_stats['bytes'] += num_bytes
+        host_stats['seconds'] += seconds
+        host_stats['max_seconds'] = max(host_stats['max_seconds'], seconds)
+
+
+def get(url, timeout=None, **kwargs):
+    """GET through the shared session, with timeouts, retries and the host's concurrency limit.
+
+    Raises requests.HTTPError for error statuses left after retrying, so error pages never reach a cache.
+    """
+    host = urlparse(url).hostname
+    timeout = timeout or (CONNECT_TIMEOUT, READ_TIMEOUT)
+    start = time.perf_counter()
+    with span('http.get', host=host), host_slot(host):
+        try:
+            response = session().get(url, timeout=timeout, **kwargs)
+            response.raise_for_status()
+        except requests.RequestException:
+            record(host, time.perf_counter() - start, error=True)
+            raise
+
+    retries = len(response.raw.retries.history) if response.raw.retries else 0
+    num_bytes = len(response.content)
+    record(host, time.perf_counter() - start, num_bytes, retries)
+    count('http.bytes', num_bytes)
+    return response
+
+
+def stats():
+    with _stats_lock:
+        return {host: dict(host_stats) for host, host_stats in _stats.items()}
+
+
+def print_stats():
+    current = stats()
+    if not current:
+        return
+    print(f"{'host':<28}{'requests':>9}{'retries':>9}{'errors':>8}{'MB':>9}{'avg s':>8}{'max s':>8}")
+    for host, host_stats in sorted(current.items()):
+        average = host_stats['seconds'] / host_stats['requests'] if host_stats['requests'] else 0.0
+        print(f"{host:<28}{host_stats['requests']:>9}{host_stats['retries']:>9}{host_stats['errors']:>8}"
+              f"{host_stats['bytes'] / 1e6:>9.2f}{average:>8.2f}{host_stats['max_seconds']:>8.2f}")
@@ -0,0 +1,95 @@
+import json
+import threading
+import time
+import traceback
+from pathlib import Path
+
+
+def journal_file(last_monday):
+    return Path(f"./.data/journal-{last_monday}.jsonl")
+
+
+class Journal:
+    """Append-only record of what a weekly run finished, one JSON object per line.
+
+    Entries are (day, paper, stage) with a payload: a day is 'listed' then 'done', a paper is
+    'done' with its sheet row or 'failed' with the error. Later lines win, so a paper that failed
+    and then succeeded on a resumed run counts as done. Without a path nothing is written.
+    """
+
+    def __init__(self, path=None, resume=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if path is None:
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if resume and path.exists():
+            self.load()
+            print(f"Resuming from {path}: {len(self.done_papers())} papers done, "
+                  f"{len(self.quarantined())} quarantined")
+        else:
+            path.write_text('')
+
+    def load(self):
+        with self.path.open() as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line torn by a crash, its stage simply runs again
+                    continue
+                self.entries[(entry['day'], entry.get('paper'), entry['stage'])] = entry
+
+    def record(self, day, stage, paper=None, **payload):
+        entry = dict(day=day, paper=paper, stage=stage, time=time.time(), **payload)
+        with self.lock:
+            self.entries[(day, paper, stage)] = entry
+            # Failures are superseded by a later success of the same paper
+            if stage == 'done':
+                self.entries.pop((day, paper, 'failed'), None)
+            if self.path is not None:
+                with self.path.open('a') as f:
+                    f.write(json.dumps(entry) + '\n')
+
+    def get(self, day, stage, paper=None):
+        with self.lock:
+            return self.entries.get((day, paper, stage))
+
+    def listing(self, day):
+        entry = self.get(day, 'listed')
+        return [tuple(item) for item in entry['listing']] if entry else None
+
+    def record_listing(self, day, listing):
+        self.record(day, 'listed', listing=listing)
+
+    def paper(self, day, paper_id):
+        entry = self.get(day, 'done', paper_id)
+        return entry['result'] if entry else None
+
+    def record_paper(self, day, paper_id, result):
+        self.record(day, 'done', paper_id, result=result)
+
+    def quarantine(self, day, paper_id, title, error):
+        self.record(day, 'failed', paper_id, title=title, error=repr(error),
+                    traceback=''.join(traceback.format_exception(type(error), error, error.__traceback__)))
+
+    def record_day(self, day, num_papers):
+        self.record(day, 'done', num_papers=num_papers)
+
+    def done_papers(self):
+        with self.lock:
+            return [entry for (_, paper, stage), entry in self.entries.items() if paper and stage == 'done']
+
+    def quarantined(self):
+        with self.lock:
+            return [entry for (_, paper, stage), entry in self.entries.items() if stage == 'failed']
+
+
+def print_quarantine(journal, retry="rerun with --resume to retry them"):
+    quarantined = journal.quarantined()
+    if not quarantined:
+        return
+    print(f"{len(quarantined)} papers quarantined and left out ({retry}):")
+    for entry in sorted(quarantined, key=lambda entry: (entry['day'], entry['paper'])):
+        print(f"  {entry['day']} {entry['paper']} {entry['title']!r}: {entry['error']}")
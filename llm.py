@@ -1,34 +1,64 @@
 import json
-import PyPDF2
-from io import BytesIO
+import threading
 from openai import OpenAI
 from dotenv import load_dotenv
 
-from cache import cache_request_get, affiliation_cache_manager, tldr_cache_manager, overview_cache_manager, \
-    paper_review_cache_manager
+from concurrency import host_slot, OPENAI_HOST
+from llm_cache import completion_cache
+from llm_executor import CompletionExecutor
+from pdf import get_pdf_text
+from tracing import count, span
 from logos import ARXIV_LOGO, HF_LOGO, EMERGENTMIND_LOGO, X_LOGO, HACKERNEWS_LOGO, REDDIT_LOGO, \
     GITHUB_LOGO, YOUTUBE_LOGO
 
 load_dotenv()
 
+# One client for the whole process, its HTTP connection pool is reused by every call and thread
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = OpenAI()
+        return _client
+
+
+def set_client(client):
+    """Use the given client (e.g. one pointed at a stub server) for every subsequent call."""
+    global _client
+    with _client_lock:
+        _client = client
+
+
+def count_usage(response):
+    usage = getattr(response, 'usage', None)
+    if usage is not None:
+        count('llm.prompt_tokens', usage.prompt_tokens or 0)
+        count('llm.completion_tokens', usage.completion_tokens or 0)
+
+
+def cached_completion(namespace, request, legacy_name=None):
+    """Completion text of a request, from the namespace's cache when the same request was made before.
+
+    On a miss, the completion the legacy stores hold for legacy_name (an arXiv id) is taken over, see LEGACY_STORES.
+    """
+    cache = completion_cache(namespace)
+    completion = cache.lookup(request)
+    if completion is None and legacy_name is not None and adopt_legacy(namespace, legacy_name, request):
+        completion = cache.lookup(request)
+    if completion is None:
+        with span(f"llm.{namespace}", model=request['model']), host_slot(OPENAI_HOST):
+            response = get_client().chat.completions.create(**request)
+        count_usage(response)
+        completion = response.choices[0].message.content
+        cache.store(request, completion)
+    return completion
 
-def get_author_affiliations(arxiv_url):
-    arxiv_id = arxiv_url.split('/')[-1]
-    cached_response = affiliation_cache_manager.get_cached_response(arxiv_id)
-    if cached_response:
-        return cached_response
-
-    pdf_content = cache_request_get(arxiv_url, f"{arxiv_id}.pdf")
-    pdf_content = BytesIO(pdf_content)
-    # Extract text from the first two pages of the PDF
-    pdf_reader = PyPDF2.PdfReader(pdf_content)
-    text = ""
-    for page in pdf_reader.pages[:2]:  # Only process the first two pages
-        text += page.extract_text()
-
-    # Initialize OpenAI client
-    client = OpenAI()
 
+def affiliation_request(text):
     # Use GPT-4o mini to extract affiliations
     prompt = (
         "Extract the author affiliations from this arXiv paper text. "
@@ -37,7 +67,7 @@ def get_author_affiliations(arxiv_url):
         f"{text[:4000]}"  # Still limiting to 4000 characters as a precaution
     )
 
-    response = client.chat.completions.create(
+    return dict(
         model="gpt-4o-mini",
         messages=[
             {"role": "system",
@@ -45,9 +75,11 @@ def get_author_affiliations(arxiv_url):
             {"role": "user", "content": prompt}
         ]
     )
-    affiliations = response.choices[0].message.content
-    affiliation_cache_manager.cache_response(arxiv_id, affiliations)
-    return affiliations
+
+
+def get_author_affiliations(arxiv_url):
+    text = get_pdf_text(arxiv_url)
+    return cached_completion('affiliation', affiliation_request(text), legacy_name=arxiv_url.split('/')[-1])
 
 
 def post_process(llm_result):
@@ -57,13 +89,7 @@ def post_process(llm_result):
     return '; '.join(json.loads(str))
 
 
-def get_tldr(arxiv_id, title, abstract):
-    cached_response = tldr_cache_manager.get_cached_response(arxiv_id)
-    if cached_response:
-        return cached_response
-
-    client = OpenAI()
-
+def tldr_request(title, abstract):
     prompt = (
         "Give a summary or tldr of a research paper given its title and abstract in three sentences or less."
         "\n\n"
@@ -71,7 +97,7 @@ def get_tldr(arxiv_id, title, abstract):
         f"abstract: {abstract}"
     )
 
-    response = client.chat.completions.create(
+    return dict(
         model="gpt-4o-mini",
         messages=[
             {"role": "system",
@@ -80,9 +106,9 @@ def get_tldr(arxiv_id, title, abstract):
         ]
     )
 
-    tldr = response.choices[0].message.content
-    tldr_cache_manager.cache_response(arxiv_id, tldr)
-    return tldr
+
+def get_tldr(title, abstract, arxiv_id=None):
+    return cached_completion('tldr', tldr_request(title, abstract), legacy_name=arxiv_id)
 
 
 def format_overview(overview):
@@ -90,13 +116,7 @@ def format_overview(overview):
     return overview
 
 
-def get_overview(last_monday, reviewed_papers):
-    cached_response = overview_cache_manager.get_cached_response(last_monday)
-    if cached_response:
-        return format_overview(cached_response)
-
-    client = OpenAI()
-
+def overview_request(reviewed_papers):
     prompt = (
         "Give an overview of papers given titles, abstracts, and notes in five sentences or less."
         "The overview should cover common topics across the papers."
@@ -110,7 +130,7 @@ def get_overview(last_monday, reviewed_papers):
         prompt += f"abstract: {paper['tldr']}\n"
         prompt += f"notes: {paper['notes']}\n\n"
 
-    response = client.chat.completions.create(
+    return dict(
         model="gpt-4o",
         messages=[
             {"role": "system",
@@ -119,10 +139,14 @@ def get_overview(last_monday, reviewed_papers):
         ]
     )
 
-    overview = response.choices[0].message.content
-    overview_cache_manager.cache_response(last_monday, overview)
 
-    return format_overview(overview)
+def get_overview(reviewed_papers):
+    return format_overview(cached_completion('overview', overview_request(reviewed_papers)))
+
+
+def has_stats(paper):
+    """Whether the sheet row carries Emergent Mind stats, sheets from before the stats stage do not."""
+    return paper.get('twitterLikesCount') not in (None, '')
 
 
 def format_review(paper, review, picked, spreadsheet_id):
@@ -149,8 +173,32 @@ def format_review(paper, review, picked, spreadsheet_id):
     def horizontal_space():
         return """&nbsp; &nbsp;"""
 
+    def stat(paper, column):
+        # -1 marks a stat the page did not have
+        return max(int(paper[column]), 0)
+
     def github_stats(paper):
-        return paper['githubStarsCount'] if int(paper['githubReposCount']) > 0 else paper['githubPagesCount']
+        if stat(paper, 'githubReposCount') > 0:
+            return stat(paper, 'githubStarsCount')
+        return stat(paper, 'githubPagesCount')
+
+    def social_media_links(paper):
+        if not has_stats(paper):
+            return ""
+        # social media: X, HackerNews, Reddit, YouTube, GitHub
+        return (
+            f"{horizontal_space()}"
+            f"{horizontal_space()}"
+            f"{make_social_media_link(X_LOGO, 'X', stat(paper, 'twitterLikesCount'))}"
+            f"{horizontal_space()}"
+            f"{make_social_media_link(HACKERNEWS_LOGO, 'HackerNews', stat(paper, 'hackerNewsPointsCount'))}"
+            f"{horizontal_space()}"
+            f"{make_social_media_link(REDDIT_LOGO, 'Reddit', stat(paper, 'redditPointsCount'))}"
+            f"{horizontal_space()}"
+            f"{make_social_media_link(YOUTUBE_LOGO, 'YouTube', stat(paper, 'youtubePaperMentionsCount'))}"
+            f"{horizontal_space()}"
+            f"{make_social_media_link(GITHUB_LOGO, 'GitHub', github_stats(paper))}"
+        )
 
     def make_social_media_link(link, tooltip, count):
         # return f"""<span>{logo} {count}</span>"""
@@ -169,18 +217,7 @@ def format_review(paper, review, picked, spreadsheet_id):
         f"{hf_link(paper)}"
         f"{horizontal_space()}"
         f"{paper['upvote']}"
-        # f"{horizontal_space()}"
-        # f"{horizontal_space()}"
-        # social media: X, HackerNews, Reddit, YouTube, GitHub
-        # f"{make_social_media_link(X_LOGO, 'X', paper['twitterLikesCount'])}"
-        # f"{horizontal_space()}"
-        # f"{make_social_media_link(HACKERNEWS_LOGO, 'HackerNews', paper['hackerNewsPointsCount'])}"
-        # f"{horizontal_space()}"
-        # f"{make_social_media_link(REDDIT_LOGO, 'Reddit', paper['redditPointsCount'])}"
-        # f"{horizontal_space()}"
-        # f"{make_social_media_link(YOUTUBE_LOGO, 'YouTube', paper['youtubePaperMentionsCount'])}"
-        # f"{horizontal_space()}"
-        # f"{make_social_media_link(GITHUB_LOGO, 'GitHub', github_stats(paper))}"
+        f"{social_media_links(paper)}"
         f"</div>"
         f"\n\n")
 
@@ -196,14 +233,7 @@ def format_review(paper, review, picked, spreadsheet_id):
     return content
 
 
-def get_paper_review(paper, spreadsheet_id, picked=False):
-    arxiv_id = paper['arXiv'].split('/')[-1]
-    cached_response = paper_review_cache_manager.get_cached_response(arxiv_id)
-    if cached_response:
-        return format_review(paper, cached_response, picked, spreadsheet_id)
-
-    client = OpenAI()
-
+def review_request(paper, picked=False):
     num_sentences = "five" if picked else "three"
 
     prompt = (
@@ -220,7 +250,7 @@ def get_paper_review(paper, spreadsheet_id, picked=False):
     prompt += f"abstract: {paper['tldr']}\n"
     prompt += f"notes: {paper['notes']}\n\n"
 
-    response = client.chat.completions.create(
+    return dict(
         model="gpt-4o",
         messages=[
             {"role": "system",
@@ -229,12 +259,109 @@ def get_paper_review(paper, spreadsheet_id, picked=False):
         ]
     )
 
-    review = response.choices[0].message.content
-    paper_review_cache_manager.cache_response(arxiv_id, review)
 
+def get_paper_review(paper, spreadsheet_id, picked=False):
+    review = cached_completion('review', review_request(paper, picked))
     return format_review(paper, review, picked, spreadsheet_id)
 
 
+# Stores of the completions made before llm_cache, keyed by arXiv id or, for overviews, by week. Overviews were
+# written to the tldr store until the overview store got its own file.
+LEGACY_STORES = {
+    'affiliation': ['affiliation_cache_manager'],
+    'tldr': ['tldr_cache_manager'],
+    'overview': ['overview_cache_manager', 'tldr_cache_manager'],
+    'review': ['paper_review_cache_manager'],
+}
+
+
+def legacy_completion(namespace, name):
+    """Completion stored under an arXiv id or week by the legacy stores, None when there is none."""
+    from cache import cache_manager
+
+    for store in LEGACY_STORES[namespace]:
+        manager = cache_manager(store)
+        if not manager.db_file.exists() and not manager.cache_file.exists():
+            continue
+        completion = manager.get_cached_response(name)
+        if completion:
+            return completion
+    return None
+
+
+def import_legacy_completions():
+    """Re-key the legacy TLDRs and affiliations under the hash of the request that made them.
+
+    The requests are rebuilt from the cached listings, paper pages and PDF text, entries whose inputs are not
+    cached any more are left behind. Entries already imported are skipped, so running it again is harmless.
+    Overviews and reviews depend on the sheet notes, prefetch_reviews adopts them when the week is reviewed.
+    """
+    from cache import cache_dir, hf_cache_manager, hfp_cache_manager, pdf_text_cache_manager
+    from process import PaperPage, parse_listing
+
+    titles = {}
+    for _, content in hf_cache_manager.items():
+        for title, paper_id in parse_listing(content):
+            titles[paper_id.split('/')[-1]] = title
+    pdf_texts = set(pdf_text_cache_manager.keys())
+
+    imported = dict(tldr=0, affiliation=0)
+    for arxiv_id in hfp_cache_manager.keys():
+        try:
+            page = PaperPage(hfp_cache_manager.get_cached_response(arxiv_id))
+        except ValueError:
+            continue
+        if arxiv_id in titles:
+            imported['tldr'] += adopt_legacy('tldr', arxiv_id, tldr_request(titles[arxiv_id], page.abstract))
+        # Keyed by the last part of the PDF link, as get_pdf_text does
+        pdf_id = page.pdf_link.split('/')[-1]
+        if pdf_id in pdf_texts or (cache_dir() / f"{pdf_id}.pdf").exists():
+            if legacy_completion('affiliation', pdf_id) is not None:
+                request = affiliation_request(get_pdf_text(page.pdf_link))
+                imported['affiliation'] += adopt_legacy('affiliation', pdf_id, request)
+    print(f"Imported {imported['tldr']} legacy TLDRs and {imported['affiliation']} legacy affiliations")
+    return imported
+
+
+def adopt_legacy(namespace, name, request):
+    """Store the legacy completion of `name` under the request's key if it has none yet. Returns 1 if stored."""
+    cache = completion_cache(namespace)
+    if cache.contains(request):
+        return 0
+    completion = legacy_completion(namespace, name)
+    if completion is None:
+        return 0
+    cache.store(request, completion)
+    return 1
+
+
+def prefetch_reviews(last_monday, picked_papers, reviewed_papers, concurrency=None):
+    """Run the uncached overview and paper reviews concurrently and cache them.
+
+    get_overview and get_paper_review then assemble the review from the cache in their usual order.
+    Requests that fail here are left uncached and retried inline by those functions.
+    """
+    pending = [('overview', last_monday, overview_request(reviewed_papers))]
+
+    picked_paper_arxivids = [paper['arXiv'] for paper in picked_papers]
+    other_papers = [paper for paper in reviewed_papers if paper['arXiv'] not in picked_paper_arxivids]
+    for paper, picked in [(paper, True) for paper in picked_papers] + [(paper, False) for paper in other_papers]:
+        pending.append(('review', paper['arXiv'].split('/')[-1], review_request(paper, picked)))
+    # A week reviewed before the completions were keyed by request keeps its published prose
+    for namespace, name, request in pending:
+        adopt_legacy(namespace, name, request)
+    pending = [(namespace, name, request) for namespace, name, request in pending
+               if not completion_cache(namespace).contains(request)]
+
+    with span('llm.prefetch_reviews', requests=len(pending)):
+        results = CompletionExecutor(concurrency=concurrency).run([request for _, _, request in pending])
+    for (namespace, name, request), result in zip(pending, results):
+        if isinstance(result, Exception):
+            print(f"Review request for {name} failed: {result!r}")
+            continue
+        completion_cache(namespace).store(request, result)
+
+
 if __name__ == '__main__':
     arxiv_url = 'https://arxiv.org/pdf/2408.08072'
     affiliations = get_author_affiliations(arxiv_url)
@@ -0,0 +1,83 @@
+import json
+import time
+from pathlib import Path
+
+from cache import cache_dir
+from llm import get_client
+from llm_cache import completion_cache
+
+ENDPOINT = '/v1/chat/completions'
+POLL_SECONDS = 30
+TERMINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+# custom_id is '<completion cache namespace>:<completion key>', results land in the cache the inline calls read from
+
+
+def batch_dir():
+    return cache_dir() / 'batches'
+
+
+def write_batch_input(requests, path):
+    with path.open('w') as f:
+        for custom_id, body in requests.items():
+            f.write(json.dumps(dict(custom_id=custom_id, method='POST', url=ENDPOINT, body=body)) + '\n')
+
+
+def cache_batch_output(output):
+    """Store every successful completion of a batch output file. Returns (cached, failed) counts."""
+    cached, failed = 0, 0
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        namespace, key = result['custom_id'].split(':', 1)
+        response = result.get('response') or {}
+        if response.get('status_code') != 200:
+            print(f"Batch request {result['custom_id']} failed: {result.get('error') or response}")
+            failed += 1
+            continue
+        completion_cache(namespace).store_key(key, response['body']['choices'][0]['message']['content'])
+        cached += 1
+    return cached, failed
+
+
+def run_batch(requests, poll_seconds=POLL_SECONDS):
+    """Submit the requests as one Batch API job, wait for it and fill the TLDR and affiliation caches.
+
+    Anything the batch does not return is simply left uncached, the regular run then makes those calls inline.
+    """
+    if not requests:
+        print("Nothing to batch, every TLDR and affiliation is cached")
+        return 0
+
+    client = get_client()
+    batch_dir().mkdir(parents=True, exist_ok=True)
+    input_file = batch_dir() / f"batch-{int(time.time())}-input.jsonl"
+    write_batch_input(requests, input_file)
+
+    with input_file.open('rb') as f:
+        uploaded = client.files.create(file=f, purpose='batch')
+    batch = client.batches.create(input_file_id=uploaded.id, endpoint=ENDPOINT, completion_window='24h')
+    print(f"Submitted batch {batch.id} with {len(requests)} requests")
+
+    while batch.status not in TERMINAL_STATUSES:
+        time.sleep(poll_seconds)
+        batch = client.batches.retrieve(batch.id)
+        counts = batch.request_counts
+        progress = f" ({counts.completed}/{counts.total} done, {counts.failed} failed)" if counts else ""
+        print(f"Batch {batch.id}: {batch.status}{progress}")
+
+    if batch.status != 'completed':
+        print(f"Batch {batch.id} ended as {batch.status}, keeping whatever results it produced")
+
+    cached, failed = 0, 0
+    if batch.output_file_id:
+        output = client.files.content(batch.output_file_id).text
+        Path(str(input_file).replace('-input', '-output')).write_text(output)
+        cached, failed = cache_batch_output(output)
+    if batch.error_file_id:
+        errors = client.files.content(batch.error_file_id).text
+        failed += cache_batch_output(errors)[1]
+
+    print(f"Batch {batch.id}: cached {cached} responses, {failed} failed")
+    return cached
@@ -0,0 +1,143 @@
+import hashlib
+import json
+import threading
+import time
+
+from cache import CacheManager, cache_dir
+from tracing import count
+
+# Settings per namespace: seconds before an entry expires (None keeps it forever) and
+# the number of entries kept, least recently used ones are evicted past it
+NAMESPACES = {
+    'affiliation': dict(ttl=None, max_entries=20_000),
+    'tldr': dict(ttl=None, max_entries=20_000),
+    'overview': dict(ttl=None, max_entries=1_000),
+    'review': dict(ttl=None, max_entries=5_000),
+}
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def completions_dir():
+    return cache_dir() / 'completions'
+
+
+def completion_key(request):
+    """Hash of everything sent to the API: model, messages and any other parameter.
+
+    Editing a prompt or switching models changes the key, so stale completions are never served.
+    """
+    canonical = json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class CompletionCache(CacheManager):
+    """Chat completions memoized by request content, one SQLite store per namespace."""
+
+    def __init__(self, namespace, ttl=None, max_entries=None):
+        super().__init__(completions_dir() / f"{namespace}.jsonl", False)
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self.stored = 0
+
+    @property
+    def connection(self):
+        with self.lock:
+            if self._connection is None:
+                connection = super().connection
+                columns = [row[1] for row in connection.execute("PRAGMA table_info(cache)")]
+                for column in ('created', 'accessed'):
+                    if column not in columns:
+                        connection.execute(f"ALTER TABLE cache ADD COLUMN {column} REAL NOT NULL DEFAULT 0")
+                connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+                connection.commit()
+            return self._connection
+
+    def fresh_row(self, key):
+        """(response, codec) of a live entry, expired entries are deleted on the way."""
+        row = self.connection.execute("SELECT response, codec, created FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if self.ttl is not None and time.time() - row[2] > self.ttl:
+            self.connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self.connection.commit()
+            self.expired += 1
+            return None
+        return row[:2]
+
+    def contains(self, request):
+        """Whether a live completion is cached, without counting a hit or miss."""
+        with self.lock:
+            return self.fresh_row(completion_key(request)) is not None
+
+    def lookup(self, request):
+        key = completion_key(request)
+        with self.lock:
+            row = self.fresh_row(key)
+            count(f"completions.{self.namespace}.{'miss' if row is None else 'hit'}")
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute("UPDATE cache SET accessed = ? WHERE key = ?", (time.time(), key))
+            self.connection.commit()
+        return self.decode(*row)
+
+    def store(self, request, response):
+        self.store_key(completion_key(request), response)
+
+    def store_key(self, key, response):
+        """Store under a key computed earlier, e.g. a Batch API custom_id."""
+        now = time.time()
+        with self.lock:
+            connection = self.connection
+            data = self.compress(response, self.codec)
+            connection.execute("INSERT OR REPLACE INTO cache (key, response, codec, created, accessed) "
+                               "VALUES (?, ?, ?, ?, ?)", (key, data, self.codec, now, now))
+            self.stored += 1
+            self.evict()
+            connection.commit()
+
+    def evict(self):
+        if self.max_entries is None:
+            return
+        excess = self.connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self.connection.execute("DELETE FROM cache WHERE key IN "
+                                    "(SELECT key FROM cache ORDER BY accessed LIMIT ?)", (excess,))
+            self.evicted += excess
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, expired=self.expired, evicted=self.evicted,
+                        stored=self.stored)
+
+
+def completion_cache(namespace):
+    with _caches_lock:
+        if namespace not in _caches:
+            _caches[namespace] = CompletionCache(namespace, **NAMESPACES[namespace])
+        return _caches[namespace]
+
+
+def all_caches():
+    return [completion_cache(namespace) for namespace in NAMESPACES]
+
+
+def print_stats():
+    used = [(cache.namespace, cache.stats()) for cache in _caches.values()]
+    used = [(namespace, stats) for namespace, stats in used if any(stats.values())]
+    if not used:
+        return
+    print(f"{'completions':<14}{'hits':>7}{'misses':>8}{'hit rate':>10}{'expired':>9}{'evicted':>9}{'stored':>8}")
+    for namespace, stats in sorted(used):
+        lookups = stats['hits'] + stats['misses']
+        hit_rate = stats['hits'] / lookups if lookups else 0.0
+        print(f"{namespace:<14}{stats['hits']:>7}{stats['misses']:>8}{hit_rate:>10.0%}"
+              f"{stats['expired']:>9}{stats['evicted']:>9}{stats['stored']:>8}")
@@ -0,0 +1,96 @@
+import asyncio
+import random
+import time
+from collections import deque
+
+import openai
+from openai import AsyncOpenAI
+
+from concurrency import HOST_LIMITS, OPENAI_HOST
+from tracing import count
+
+# Our account limits for the models we use, override per executor when they change
+TOKENS_PER_MINUTE = 800_000
+MAX_RETRIES = 6
+BACKOFF_SECONDS = 1.0
+# Completion tokens reserved per request when it sets no max_tokens, the API counts them against the limit
+COMPLETION_TOKENS_ESTIMATE = 400
+
+
+def estimate_tokens(request):
+    """Rough token count of a request, about four characters per token plus the expected completion."""
+    prompt_chars = sum(len(message['content']) for message in request['messages'])
+    return prompt_chars // 4 + request.get('max_tokens', COMPLETION_TOKENS_ESTIMATE)
+
+
+def retry_after(error):
+    try:
+        return float(error.response.headers.get('retry-after'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class CompletionExecutor:
+    """Runs many chat completion requests concurrently on one AsyncOpenAI client.
+
+    At most `concurrency` requests are in flight, tokens sent in any 60 second window stay
+    under `tokens_per_minute`, and 429/5xx responses are retried with jittered backoff
+    (honouring Retry-After).
+    """
+
+    def __init__(self, concurrency=None, tokens_per_minute=TOKENS_PER_MINUTE, max_retries=MAX_RETRIES,
+                 client_factory=AsyncOpenAI):
+        self.concurrency = concurrency or HOST_LIMITS[OPENAI_HOST]
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.client_factory = client_factory
+        self.window = deque()
+
+    async def reserve_tokens(self, tokens):
+        """Wait until sending `tokens` more keeps the last minute under the limit."""
+        tokens = min(tokens, self.tokens_per_minute)
+        async with self.window_lock:
+            while True:
+                now = time.monotonic()
+                while self.window and now - self.window[0][0] >= 60:
+                    self.window.popleft()
+                if sum(used for _, used in self.window) + tokens <= self.tokens_per_minute:
+                    self.window.append((now, tokens))
+                    return
+                await asyncio.sleep(60 - (now - self.window[0][0]))
+
+    async def complete(self, client, request):
+        await self.reserve_tokens(estimate_tokens(request))
+        async with self.semaphore:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = await client.chat.completions.create(**request)
+                    if response.usage is not None:
+                        count('llm.prompt_tokens', response.usage.prompt_tokens or 0)
+                        count('llm.completion_tokens', response.usage.completion_tokens or 0)
+                    return response.choices[0].message.content
+                except (openai.RateLimitError, openai.InternalServerError) as error:
+                    count('llm.retries')
+                    if attempt == self.max_retries:
+                        raise
+                    delay = retry_after(error) or BACKOFF_SECONDS * 2 ** attempt
+                    await asyncio.sleep(delay + random.uniform(0, BACKOFF_SECONDS))
+
+    async def complete_all(self, requests):
+        # Loop-bound primitives and client are created inside the running loop
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.window_lock = asyncio.Lock()
+        # Our own retry loop handles 429s, SDK retries would multiply the attempts
+        async with self.client_factory(max_retries=0) as client:
+            return await asyncio.gather(*(self.complete(client, request) for request in requests),
+                                        return_exceptions=True)
+
+    def run(self, requests):
+        """Complete every request, results come back in request order.
+
+        A request that still fails after retrying yields its exception instead of a string.
+        """
+        requests = list(requests)
+        if not requests:
+            return []
+        return asyncio.run(self.complete_all(requests))
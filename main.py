@@ -1,55 +1,312 @@
 import argparse
-from datetime import datetime
-
-from gsheet import GSheet, GSheetReader
-from llm import get_overview, get_paper_review
-from process import fetch_huggingface_papers
-from utils import append_tsv, read_tsv_dict, get_last_monday, full_url
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
+
+# Only light modules at the top: the Google, OpenAI, PyPDF2 and bs4 clients are imported by the
+# functions that use them, so --help and the modes that do not need them start quickly
+import llm_cache
+import tracing
+from cache import CODECS, compact_all
+from concurrency import map_ordered
+from journal import Journal, journal_file, print_quarantine
+from utils import append_tsv, read_tsv_dict, get_last_monday, full_url, week_monday, weekdays
 
 SPREADSHEET_FILE = './.data/spreadsheets.tsv'
+# Papers of a day processed concurrently, per-host limits live in concurrency.HOST_LIMITS
+PAPER_WORKERS = 8
+WRAP_COLUMNS = ['notes', 'title', 'tldr', 'affiliations']
+# Sheet columns read back by the review, see llm.format_review and the review prompts,
+# plus the Emergent Mind STAT_COLUMNS
+REVIEW_COLUMNS = ['notes', 'pick', 'title', 'tldr', 'affiliations', 'upvote', 'arXiv', 'url', 'arXivPdf']
 
 
 def review_file(day):
     return f"./.data/review-{day}.md"
 
-def retrieve_papers():
+def retrieve_paper(day, entry, journal, refresh=False):
+    """Sheet row of one listed paper, None when it failed and was quarantined.
+
+    The row has no LLM columns yet, see enrich_papers, unless the journal already has the paper done.
+    refresh fetches the paper page again instead of reading the cached one.
+    """
+    from process import fetch_paper, HUGGINGFACE_PAPERS_URL
+
+    title, paper_id = entry
+    paper = journal.paper(day, paper_id)
+    if paper is None:
+        try:
+            paper = fetch_paper(HUGGINGFACE_PAPERS_URL, day, title, paper_id, refresh)
+        except Exception as e:
+            print(f"Quarantined {paper_id} ({day}): {e!r}")
+            journal.quarantine(day, paper_id, title, e)
+            return None
+    return paper
+
+
+def retrieve_day(day, journal=None, refresh=False):
+    """Fetch the papers of one day. Returns (day, papers, seconds, error), a failed day has papers=None.
+
+    Papers already in the journal are not fetched again, a paper that fails is quarantined in the
+    journal and left out instead of failing the day. refresh fetches the listing and paper pages
+    again and replaces their cached copies.
+    """
+    from process import list_huggingface_papers, HUGGINGFACE_PAPERS_URL
+
+    journal = journal or Journal()
+    print(f"Processing papers for date: {day}")
+    start = time.perf_counter()
+    try:
+        listing = journal.listing(day)
+        if listing is None:
+            listing = list_huggingface_papers(HUGGINGFACE_PAPERS_URL, day, refresh)
+            journal.record_listing(day, listing)
+        day_papers = map_ordered(lambda entry: retrieve_paper(day, entry, journal, refresh), listing,
+                                 workers=PAPER_WORKERS)
+        day_papers = [paper for paper in day_papers if paper is not None]
+        journal.record_day(day, len(day_papers))
+        return day, day_papers, time.perf_counter() - start, None
+    except Exception as e:
+        traceback.print_exc()
+        return day, None, time.perf_counter() - start, e
+
+
+def enrich_papers(papers, journal=None, workers=PAPER_WORKERS):
+    """Add the TLDR and affiliations of the deduplicated papers, the only stage calling OpenAI.
+
+    A paper whose calls fail is quarantined and left out, papers done in the journal are kept as they are.
+    """
+    from process import enrich_paper
+
+    journal = journal or Journal()
+
+    def enrich(paper):
+        if 'tldr' in paper:
+            return paper
+        paper_id = urlparse(paper['url']).path
+        try:
+            paper = enrich_paper(paper)
+        except Exception as e:
+            print(f"Quarantined {paper_id} ({paper['date']}): {e!r}")
+            journal.quarantine(paper['date'], paper_id, paper['title'], e)
+            return None
+        journal.record_paper(paper['date'], paper_id, paper)
+        return paper
+
+    return [paper for paper in map_ordered(enrich, papers, workers=workers) if paper is not None]
+
+
+def print_day_summary(results, journal=None, enrichment=None):
+    """Papers, seconds and status per day. enrichment is (papers, seconds) of a week-wide enrichment stage,
+    whose time is not in the days' seconds."""
+    quarantined = [entry['day'] for entry in journal.quarantined()] if journal else []
+    print(f"{'day':<12}{'papers':>8}{'seconds':>10}  status")
+    for day, day_papers, seconds, error in results:
+        count = len(day_papers) if day_papers is not None else 0
+        status = "ok" if error is None else f"failed: {error!r}"
+        if quarantined.count(day):
+            status += f", {quarantined.count(day)} quarantined"
+        print(f"{day:<12}{count:>8}{seconds:>10.1f}  {status}")
+    if enrichment is not None:
+        papers, seconds = enrichment
+        print(f"{'enrichment':<12}{papers:>8}{seconds:>10.1f}  TLDRs and affiliations of the deduplicated week, "
+              f"the days above cover listing and paper pages")
+
+
+def prefetch_with_batch(papers):
+    """Fill the TLDR and affiliation caches of the papers with one Batch API job."""
+    from llm_batch import run_batch
+    from process import collect_llm_requests
+
+    try:
+        requests = collect_llm_requests([paper for paper in papers if 'tldr' not in paper], workers=PAPER_WORKERS)
+    except Exception:
+        # The papers are retried, and quarantined if need be, by the regular run
+        traceback.print_exc()
+        return
+    run_batch(requests)
+
+
+def retrieve_papers(workers=1, batch=False, sync=False, resume=False, stats=True):
+    import dataset
+    import http_client
+    from dedup import dedup_papers
+    from emergentmind import fetch_all_stats, STAT_COLUMNS
+    from gsheet import GSheet, write_columns
+
     days, last_monday = get_last_monday()
 
     spreadsheets = read_tsv_dict(SPREADSHEET_FILE)
-    if last_monday in spreadsheets:
-        print(f"Spreadsheet for {last_monday} already exists: {spreadsheets[last_monday]}")
+    existing_spreadsheet_id = spreadsheets.get(last_monday)
+    if existing_spreadsheet_id and not sync:
+        print(f"Spreadsheet for {last_monday} already exists: {existing_spreadsheet_id}")
         return
 
+    # Records every listing and paper as it completes, --resume picks up from it after a crash
+    journal = Journal(journal_file(last_monday), resume=resume)
+
+    # Days are independent until the final sort, a failed day does not discard the others. A sync fetches
+    # the listings and paper pages again, the cached ones miss the papers and upvotes added since
+    results = map_ordered(lambda day: retrieve_day(day, journal, refresh=sync), days, workers=workers)
+
     papers = []
-    for day in days:
-        print(f"Processing papers for date: {day}")
-        day_papers = fetch_huggingface_papers(paper_date=day)
-        papers.extend(day_papers)
+    for day, day_papers, seconds, error in results:
+        if day_papers is not None:
+            papers.extend(day_papers)
+
+    # Repeated and near-identical papers are dropped before any OpenAI request is made for them, aliases maps
+    # the dropped near-duplicates to the copy kept, so a sync finds rows written with another copy
+    aliases = {}
+    papers = dedup_papers(papers, aliases=aliases)
+    if batch:
+        prefetch_with_batch(papers)
+    start = time.perf_counter()
+    papers = enrich_papers(papers, journal, workers=PAPER_WORKERS * workers)
+    enrichment = len(papers), time.perf_counter() - start
+
+    print_day_summary(results, journal, enrichment)
+    print_quarantine(journal)
+    http_client.print_stats()
+    llm_cache.print_stats()
+
+    if not papers:
+        print(f"No papers retrieved for the week of {last_monday}")
+        return
 
-    papers = sorted(papers, key=lambda x: x['upvote'], reverse=True)
+    failed_days = [day for day, day_papers, seconds, error in results if error is not None]
+    if failed_days:
+        print(f"Warning: the spreadsheet is missing papers for {', '.join(failed_days)}")
 
-    spreadsheet_name = f"Paper Review: {last_monday}"
-    gsheet = GSheet(papers, spreadsheet_name)
-    spreadsheet_id = gsheet.create_spreadsheet()
+    papers = sorted(papers, key=lambda x: x['upvote'], reverse=True)
+    arxiv_urls = [paper['arXiv'] for paper in papers]
+    # The local dataset is the record of the week, the sheet is where notes and picks are made
+    dataset.write_week(last_monday, papers)
+
+    # Emergent Mind stats are their own stage, fetched while the sheet is written
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        stats_future = executor.submit(fetch_all_stats, arxiv_urls) if stats else None
+
+        spreadsheet_name = f"Paper Review: {last_monday}"
+        if existing_spreadsheet_id:
+            spreadsheet_id = existing_spreadsheet_id
+            appended, updated = GSheet(papers, spreadsheet_name).sync(spreadsheet_id, wrap_columns=WRAP_COLUMNS,
+                                                                    aliases=aliases)
+            print(f"Spreadsheet {full_url(spreadsheet_id)} synced: "
+                  f"{appended} papers appended, {updated} cells updated")
+        else:
+            spreadsheet_id = build_sheet(papers, spreadsheet_name)
+
+            # gsheet.make_sheet_public()
+
+            print(f"Spreadsheet titled {spreadsheet_name} created: {full_url(spreadsheet_id)}")
+            append_tsv(SPREADSHEET_FILE, [last_monday, spreadsheet_id])
+
+        if stats_future is not None:
+            week_stats = stats_future.result()
+            dataset.update(last_monday, week_stats)
+            written = write_columns(spreadsheet_id, STAT_COLUMNS, week_stats)
+            print(f"Emergent Mind stats written for {written} of {len(arxiv_urls)} papers")
+
+
+def backfill(first_day, last_day, workers=1):
+    """Fetch every weekday from first_day to last_day into the local dataset, days already there are skipped.
+
+    Papers are fetched and enriched as by retrieve: one that fails is quarantined and its day written without
+    it. A day whose listing fails is not written, it is reported and retried by the next run. Papers already
+    stored for the week, or listed by another day of the week in this run, are left out of a day.
+    """
+    import dataset
+    import http_client
+    from dedup import arxiv_id, dedup_papers
+
+    days = weekdays(first_day, last_day)
+    completed = dataset.completed_days()
+    pending = [day for day in days if day not in completed]
+    print(f"Backfilling {len(pending)} of {len(days)} weekdays from {first_day} to {last_day}, "
+          f"{len(days) - len(pending)} already in {dataset.dataset_dir()}")
+    journal = Journal()
+    # Papers of each week stored or claimed by a day of this run, a paper listed on several days is kept once
+    week_papers = {}
+    week_lock = threading.Lock()
+
+    def new_to_week(day, papers):
+        monday = week_monday(day)
+        with week_lock:
+            if monday not in week_papers:
+                stored = dataset.read(weeks=[monday], columns=['title', 'upvote', 'paperOfTheDay', 'abstract',
+                                                               'arXiv'])
+                week_papers[monday] = dataset.records(stored)
+            known = week_papers[monday]
+            aliases = {}
+            papers = dedup_papers(known + papers, aliases=aliases)
+            # Near-duplicates of a known paper are left out even when dedup kept them over it
+            known_ids = {arxiv_id(paper) for paper in known}
+            known_ids |= {aliases[key] for key in known_ids if key in aliases}
+            papers = [paper for paper in papers if arxiv_id(paper) not in known_ids]
+            known.extend(papers)
+        return papers
+
+    def backfill_day(day):
+        start = time.perf_counter()
+        day, papers, _, error = retrieve_day(day, journal)
+        if error is not None:
+            return day, None, time.perf_counter() - start, error
+        try:
+            papers = enrich_papers(new_to_week(day, papers), journal)
+            dataset.write_day(day, papers)
+            return day, papers, time.perf_counter() - start, None
+        except Exception as e:
+            print(f"Backfill of {day} failed: {e!r}")
+            return day, None, time.perf_counter() - start, e
+
+    # Days share the per-host limits of concurrency.HOST_LIMITS, so more workers never means more load per host
+    results = map_ordered(backfill_day, pending, workers=workers)
+    print_day_summary(results, journal)
+    print_quarantine(journal, retry="delete the day's file in the dataset and backfill again to retry them")
+    http_client.print_stats()
+    llm_cache.print_stats()
+
+    failed_days = [day for day, day_papers, seconds, error in results if error is not None]
+    if failed_days:
+        print(f"{len(failed_days)} days failed, run backfill again to retry them: {', '.join(failed_days)}")
+
+
+def build_sheet(papers, spreadsheet_name, service=None):
+    """Create the weekly spreadsheet, returns its id."""
+    from gsheet import GSheet
+
+    # Deferred: the whole sheet is sent with the spreadsheets.create call in commit()
+    gsheet = GSheet(papers, spreadsheet_name, service=service, deferred=True)
+    gsheet.create_spreadsheet()
 
     gsheet.insert_clickable_urls(gsheet.titles, gsheet.pdf_urls)
 
     gsheet.insert_notes(gsheet.abstracts, 'tldr')
 
-    gsheet.wrap_text_in_columns(['notes', 'title', 'tldr', 'affiliations'], "WRAP")
+    gsheet.wrap_text_in_columns(WRAP_COLUMNS, "WRAP")
+
+    gsheet.set_cell_dims(WRAP_COLUMNS, [400, 200, 500, 200], dim='COLUMNS')
+
+    return gsheet.commit()
 
-    gsheet.set_cell_dims(['notes', 'title', 'tldr', 'affiliations'], [400, 200, 500, 200], dim='COLUMNS')
 
-    # gsheet.make_sheet_public()
+def generate_review_aux(picked_papers, reviewed_papers, last_monday, spreadsheet_id, concurrency=None,
+                        picked_paper_short_title=None):
+    from llm import get_overview, get_paper_review, prefetch_reviews, has_stats
 
-    print(f"Spreadsheet titled {spreadsheet_name} created: {full_url(spreadsheet_id)}")
-    append_tsv(SPREADSHEET_FILE, [last_monday, spreadsheet_id])
+    # The overview and every paper review are independent, run them while waiting for the short title
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        prefetch = executor.submit(prefetch_reviews, last_monday, picked_papers, reviewed_papers, concurrency)
 
+        # pick the first paper from the picked_papers list
+        print(f"Picked paper: {picked_papers[0]['title']}")
+        if picked_paper_short_title is None:
+            picked_paper_short_title = input("Enter the short title for the picked paper: ")
 
-def generate_review_aux(picked_papers, reviewed_papers, last_monday, spreadsheet_id):
-    # pick the first paper from the picked_papers list
-    print(f"Picked paper: {picked_papers[0]['title']}")
-    picked_paper_short_title = input("Enter the short title for the picked paper: ")
+        prefetch.result()
 
     # convert last_monday which has format 'YYYY-MM-DD' to 'M/D/YYYY'
     date_obj = datetime.strptime(last_monday, '%Y-%m-%d')
@@ -58,7 +315,7 @@ def generate_review_aux(picked_papers, reviewed_papers, last_monday, spreadsheet
     title = f"Weekly paper roundup: {picked_paper_short_title} ({new_date})"
     print(title)
 
-    over_view = get_overview(last_monday, reviewed_papers)
+    over_view = get_overview(reviewed_papers)
     content = f"# {title}\n\n{over_view}\n\n"
 
     for picked_paper in picked_papers:
@@ -76,16 +333,22 @@ def generate_review_aux(picked_papers, reviewed_papers, last_monday, spreadsheet
     content += ("\n\n"
                 "### Acknowledgements\n\n"
                 "Papers are retrieved from [Hugging Face](https://huggingface.co/papers).\n\n"
-                # "Social media metrics are from [Emergent Mind](https://www.emergentmind.com/).\n\n"
                 )
+    if any(has_stats(paper) for paper in reviewed_papers):
+        content += "Social media metrics are from [Emergent Mind](https://www.emergentmind.com/).\n\n"
 
 
     with open(review_file(last_monday), 'w') as f:
         f.write(content)
+    llm_cache.print_stats()
     return content
 
 
-def generate_review():
+def generate_review(concurrency=None):
+    import dataset
+    from emergentmind import STAT_COLUMNS
+    from gsheet import GSheetReader
+
     days, last_monday = get_last_monday()
 
     spreadsheets = read_tsv_dict(SPREADSHEET_FILE)
@@ -94,12 +357,34 @@ def generate_review():
         return
 
     spreadsheet_id = spreadsheets[last_monday]
-
-    # read the spreadsheet from its URL using google api
-    papers = GSheetReader(spreadsheet_id).read_sheet()
-
-    for i, paper in enumerate(papers):
-        paper['row_index'] = i + 2
+    columns = REVIEW_COLUMNS + STAT_COLUMNS
+    reader = GSheetReader(spreadsheet_id)
+
+    week = dataset.read(weeks=[last_monday], columns=columns)
+    if len(week):
+        # Only the notes and picks come from the sheet, stored in the dataset, the rest is read locally
+        marks = {key: dict(notes='', pick='') for key in week['arXiv']}
+        sheet_rows = {}
+        for row in reader.read_rows(['arXiv', 'notes', 'pick'], filter_columns=['notes', 'pick']):
+            marks[row['arXiv']] = dict(notes=row['notes'], pick=row['pick'])
+            sheet_rows.setdefault(row['arXiv'], row['row_index'])
+        dataset.update(last_monday, marks)
+        week = dataset.read(weeks=[last_monday], columns=columns)
+        # One record per paper, days backfilled separately can hold the same paper
+        stored = {}
+        for paper in dataset.records(week):
+            stored.setdefault(paper['arXiv'], paper)
+        # Marked rows whose paper is not stored, e.g. left out of a day rewritten by --sync, are read from the sheet
+        missing = set(sheet_rows) - set(stored)
+        if missing:
+            stored.update((row['arXiv'], row) for row in reader.read_rows(columns, filter_columns=['notes', 'pick'])
+                          if row['arXiv'] in missing)
+        # The marked sheet rows, in the sheet's order: rows appended by --sync come after the others there too
+        papers = [stored[key] for key in sorted(sheet_rows, key=sheet_rows.get)]
+    else:
+        # Weeks retrieved before the dataset existed: read only the rows with notes or a pick, and only
+        # the columns the review uses
+        papers = list(reader.read_rows(columns, filter_columns=['notes', 'pick']))
 
     # find the paper where the pick column is non-empty
     picked_papers = []
@@ -112,24 +397,93 @@ def generate_review():
 
     # sort reviewed_papers by the upvote column in descending order
     reviewed_papers = sorted(reviewed_papers, key=lambda x: int(x['upvote']), reverse=True)
-    generate_review_aux(picked_papers, reviewed_papers, last_monday, spreadsheet_id)
+    generate_review_aux(picked_papers, reviewed_papers, last_monday, spreadsheet_id, concurrency)
 
 
 def publish_review():
     pass
 
 
+def search_papers(query, since=None, limit=20, semantic=False):
+    from search_index import SearchIndex, print_results
+
+    index = SearchIndex()
+    # Only papers cached since the last search are parsed and indexed
+    added = index.update()
+    print(f"{index.size()} papers indexed ({added} new)")
+    if semantic:
+        print(f"{index.update_embeddings()} new papers embedded")
+        print_results(index.semantic_search([query], since=since, limit=limit)[0])
+    else:
+        print_results(index.search(query, since=since, limit=limit))
+
+
 if __name__ == '__main__':
     # run()
     parser = argparse.ArgumentParser(description="Process papers with three modes: retrieve, review, and publish.")
-    parser.add_argument("mode", choices=["retrieve", "review", "publish"], help="Mode of operation")
-    args = parser.parse_args()
-
-    if args.mode == "retrieve":
-        retrieve_papers()
-    elif args.mode == "review":
-        generate_review()
-    elif args.mode == "publish":
-        publish_review()
+    parser.add_argument("mode", choices=["retrieve", "review", "publish", "compact", "search", "backfill"],
+                        help="Mode of operation")
+    parser.add_argument("query", nargs="*",
+                        help="search: words or an FTS5 query, e.g. '\"speculative decoding\"' or 'LoRA OR adapter'")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="retrieve, backfill: number of days processed in parallel (default: 1)")
+    parser.add_argument("--from", dest="first_day", default=None,
+                        help="backfill: first day of the range (YYYY-MM-DD)")
+    parser.add_argument("--to", dest="last_day", default=None,
+                        help="backfill: last day of the range (YYYY-MM-DD, default: yesterday)")
+    parser.add_argument("--batch", action="store_true",
+                        help="retrieve: make the week's TLDR and affiliation calls as one OpenAI Batch API job")
+    parser.add_argument("--sync", action="store_true",
+                        help="retrieve: update this week's existing spreadsheet with new papers and upvotes")
+    parser.add_argument("--resume", action="store_true",
+                        help="retrieve: continue the week's last run from its journal, retrying quarantined papers")
+    parser.add_argument("--no-stats", action="store_true",
+                        help="retrieve: skip the Emergent Mind social media stats columns")
+    parser.add_argument("--discard-pdfs", action="store_true",
+                        help="retrieve, backfill: keep only the extracted first-page text of arXiv PDFs, not the files")
+    parser.add_argument("--concurrency", type=int, default=None,
+                        help="review: maximum number of OpenAI requests in flight (default: the OpenAI host limit)")
+    parser.add_argument("--codec", choices=CODECS, default=None,
+                        help="compact: re-encode the caches with this codec (default: keep the current one)")
+    parser.add_argument("--since", default=None,
+                        help="search: only papers listed on or after this date (YYYY-MM-DD)")
+    parser.add_argument("--limit", type=int, default=20, help="search: number of results (default: 20)")
+    parser.add_argument("--semantic", action="store_true",
+                        help="search: rank by OpenAI embedding similarity instead of full-text relevance")
+    parser.add_argument("--trace", nargs="?", const="", default=None, metavar="FILE",
+                        help="time every stage, print a summary and write a Chrome trace to FILE "
+                             "(default: .data/trace-<mode>-<time>.json)")
+    # Intermixed, so search words may come before or after the options
+    args = parser.parse_intermixed_args()
+
+    if args.trace is not None:
+        tracing.enable()
+
+    try:
+        with tracing.span(f"run.{args.mode}"):
+            if args.mode == "retrieve":
+                import pdf
+                pdf.KEEP_PDFS = not args.discard_pdfs
+                retrieve_papers(workers=args.workers, batch=args.batch, sync=args.sync, resume=args.resume,
+                                stats=not args.no_stats)
+            elif args.mode == "review":
+                generate_review(concurrency=args.concurrency)
+            elif args.mode == "publish":
+                publish_review()
+            elif args.mode == "compact":
+                compact_all(args.codec)
+            elif args.mode == "search":
+                search_papers(' '.join(args.query), since=args.since, limit=args.limit, semantic=args.semantic)
+            elif args.mode == "backfill":
+                if args.first_day is None:
+                    parser.error("backfill needs --from YYYY-MM-DD")
+                import pdf
+                pdf.KEEP_PDFS = not args.discard_pdfs
+                last_day = args.last_day or (datetime.today() - timedelta(days=1)).strftime('%Y-%m-%d')
+                backfill(args.first_day, last_day, workers=args.workers)
+    finally:
+        if args.trace is not None:
+            tracing.print_summary()
+            tracing.write_trace(args.trace or f".data/trace-{args.mode}-{time.strftime('%Y%m%d-%H%M%S')}.json")
 
 #%%
\ No newline at end of file
@@ -0,0 +1,155 @@
+import io
+import time
+
+import PyPDF2
+
+import http_client
+from cache import cache_dir, pdf_text_cache_manager
+from tracing import count, span
+
+# Only the first pages are read, affiliations are on the title page
+PAGES = 2
+# affiliation_request keeps this many characters, a longer first page makes the second one unnecessary
+TEXT_CHARS = 4000
+BLOCK_SIZE = 256 * 1024
+# Past this many range requests the rest of the file is fetched in one go
+MAX_RANGE_REQUESTS = 16
+# Write fully downloaded PDFs to .cache/<id>.pdf, main.py retrieve --discard-pdfs turns it off
+KEEP_PDFS = True
+
+
+class RemotePdf(io.RawIOBase):
+    """Read-only seekable file over a remote PDF, fetched in blocks with HTTP range requests.
+
+    PyPDF2 reads the trailer and cross-reference table at the end of the file and then only the
+    objects of the pages it is asked for, so the rest of the PDF is never transferred. When the
+    server ignores Range the whole file arrives with the first response and is served from memory.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.position = 0
+        self.blocks = {}
+        self.range_requests = 0
+        self.bytes_fetched = 0
+
+        response = self.get_range(0, BLOCK_SIZE - 1)
+        if response.status_code == 206:
+            self.size = int(response.headers['Content-Range'].split('/')[-1])
+            self.full_content = None
+            self.blocks[0] = response.content
+        else:
+            self.size = len(response.content)
+            self.full_content = response.content
+
+    def get_range(self, start, end):
+        response = http_client.get(self.url, headers={'Range': f"bytes={start}-{end}"})
+        self.range_requests += 1
+        self.bytes_fetched += len(response.content)
+        return response
+
+    def block(self, index):
+        if index not in self.blocks:
+            if self.range_requests >= MAX_RANGE_REQUESTS:
+                # Scattered objects, finish with a single request for everything not fetched yet
+                self.fetch_rest()
+            else:
+                start = index * BLOCK_SIZE
+                self.blocks[index] = self.get_range(start, min(start + BLOCK_SIZE, self.size) - 1).content
+        return self.blocks[index]
+
+    def fetch_rest(self):
+        missing = [i for i in range((self.size + BLOCK_SIZE - 1) // BLOCK_SIZE) if i not in self.blocks]
+        start = missing[0] * BLOCK_SIZE
+        data = self.get_range(start, self.size - 1).content
+        for i in missing:
+            offset = i * BLOCK_SIZE - start
+            self.blocks[i] = data[offset:offset + BLOCK_SIZE]
+
+    @property
+    def complete(self):
+        return self.full_content is not None or len(self.blocks) * BLOCK_SIZE >= self.size
+
+    def content(self):
+        if self.full_content is not None:
+            return self.full_content
+        return b''.join(self.blocks[i] for i in sorted(self.blocks))
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else min(self.size, self.position + size)
+        if self.position >= end:
+            return b''
+        if self.full_content is not None:
+            data = self.full_content[self.position:end]
+        else:
+            chunks = []
+            for index in range(self.position // BLOCK_SIZE, (end - 1) // BLOCK_SIZE + 1):
+                block_start = index * BLOCK_SIZE
+                block = self.block(index)
+                chunks.append(block[max(self.position - block_start, 0):end - block_start])
+            data = b''.join(chunks)
+        self.position += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def extract_first_pages(stream):
+    pdf_reader = PyPDF2.PdfReader(stream)
+    text = ""
+    for page in pdf_reader.pages[:PAGES]:
+        if len(text) >= TEXT_CHARS:
+            break
+        text += page.extract_text()
+    return text
+
+
+def get_pdf_text(arxiv_url):
+    """Text of the first pages of an arXiv PDF, cached on its own so the PDF is parsed once."""
+    arxiv_id = arxiv_url.split('/')[-1]
+    text = pdf_text_cache_manager.get_cached_response(arxiv_id)
+    if text is not None:
+        return text
+
+    pdf_file = cache_dir() / f"{arxiv_id}.pdf"
+    if pdf_file.exists():
+        with span('pdf.parse', source='file'):
+            text = extract_first_pages(io.BytesIO(pdf_file.read_bytes()))
+    else:
+        start = time.perf_counter()
+        # Range requests are made as PyPDF2 reads, download and parsing share the span
+        with span('pdf.fetch_parse', source='remote') as pdf_span:
+            remote = RemotePdf(arxiv_url)
+            text = extract_first_pages(remote)
+            pdf_span.set(bytes=remote.bytes_fetched, size=remote.size, range_requests=remote.range_requests)
+        count('pdf.bytes_fetched', remote.bytes_fetched)
+        count('pdf.bytes_total', remote.size)
+        mode = "full download" if remote.full_content is not None else f"{remote.range_requests} range requests"
+        print(f"PDF {arxiv_id}: fetched {remote.bytes_fetched / 1e3:.0f} KB of {remote.size / 1e3:.0f} KB "
+              f"({mode}), held {len(remote.content()) / 1e3:.0f} KB in memory, "
+              f"{time.perf_counter() - start:.1f}s")
+        if KEEP_PDFS and remote.complete:
+            pdf_file.write_bytes(remote.content())
+
+    pdf_text_cache_manager.cache_response(arxiv_id, text)
+    return text
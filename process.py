@@ -1,61 +1,165 @@
-import requests
 from bs4 import BeautifulSoup
+from importlib.util import find_spec
 from urllib.parse import urljoin
 
-from emergentmind import get_stats
-from llm import get_author_affiliations, post_process, get_tldr
+from llm import get_author_affiliations, post_process, get_tldr, tldr_request, affiliation_request, adopt_legacy
+from pdf import get_pdf_text
 from cache import hf_cache_manager, hfp_cache_manager
+from llm_cache import completion_cache, completion_key
+import http_client
+from concurrency import map_ordered
+from tracing import span, traced
 
+# lxml builds the tree several times faster than the pure-python parser, use it when installed
+HTML_PARSER = 'lxml' if find_spec('lxml') else 'html.parser'
+HUGGINGFACE_PAPERS_URL = "https://huggingface.co/papers"
 
-def fetch_huggingface_papers(url="https://huggingface.co/papers", paper_date='2024-08-12'):
-    content = hf_cache_manager.get_cached_response(paper_date)
+
+@traced('hf.listing')
+def list_huggingface_papers(url, paper_date, refresh=False):
+    """(title, paper_id) of every paper listed for the day, refresh fetches it again over the cached copy."""
+    content = None if refresh else hf_cache_manager.get_cached_response(paper_date)
     if content is None:
-        content = (requests.get(f"{url}?date={paper_date}")).text
+        content = http_client.get(url, params=dict(date=paper_date)).text
         hf_cache_manager.cache_response(paper_date, content)
 
+    with span('parse.listing'):
+        return parse_listing(content)
+
+
+def parse_listing(content):
     soup = BeautifulSoup(content, 'html.parser')
 
-    papers = []
+    listing = []
     for paper in soup.select('div.from-gray-50-to-white'):
         title_element = paper.select_one('h3 a')
-        title = title_element.text.strip()
-
-        paper_id = title_element['href']
-        hf_paper_url = urljoin(url, paper_id)
-        arxiv_paper_id = paper_id.split('/')[-1]
-        # print(arxiv_paper_id)
-
-        # Get the last part of the relative_link for the cache filename
-        # paper_content = cache_request_get(absolute_url, cache_filename)
-        paper_content = hfp_cache_manager.get_cached_response(arxiv_paper_id)
-        if paper_content is None:
-            paper_content = (requests.get(hf_paper_url)).text
-            hfp_cache_manager.cache_response(arxiv_paper_id, paper_content)
-
-        paper_of_the_day = extract_href_with_text(paper_content, 'Paper of the day', silent=True)
-        pdf_link = extract_href_with_text(paper_content, 'View PDF')
-
-        abstract = extract_abstract(paper_content)
-        tldr = get_tldr(arxiv_paper_id, title, abstract)
-        # social_media_stats = get_stats(arxiv_paper_id)
-
-        papers.append(dict(
-            notes="",
-            pick="",
-            title=title,
-            tldr=tldr,
-            affiliations=post_process(get_author_affiliations(pdf_link)),
-            upvote=extract_upvote_count(paper_content),
-            paperOfTheDay=paper_date if paper_of_the_day else None,
-            # **social_media_stats,
-            abstract=abstract,
-            date=paper_date,
-            arXiv=extract_href_with_text(paper_content, 'View arXiv page'),
-            url=hf_paper_url,
-            arXivPdf=pdf_link
-        ))
-
-    return papers
+        listing.append((title_element.text.strip(), title_element['href']))
+    return listing
+
+
+def fetch_huggingface_papers(url=HUGGINGFACE_PAPERS_URL, paper_date='2024-08-12', workers=1):
+    """Sheet rows of the day's papers."""
+    listing = list_huggingface_papers(url, paper_date)
+
+    # Per-paper work is independent, fan it out and keep the listing order
+    return map_ordered(lambda entry: process_paper(url, paper_date, *entry), listing, workers=workers)
+
+
+@traced('hf.paper_page')
+def fetch_paper_page(url, paper_id, refresh=False):
+    hf_paper_url = urljoin(url, paper_id)
+    arxiv_paper_id = paper_id.split('/')[-1]
+    # print(arxiv_paper_id)
+
+    # Get the last part of the relative_link for the cache filename
+    # paper_content = cache_request_get(absolute_url, cache_filename)
+    # Upvotes change during the week, refresh replaces the cached page
+    paper_content = None if refresh else hfp_cache_manager.get_cached_response(arxiv_paper_id)
+    if paper_content is None:
+        paper_content = http_client.get(hf_paper_url).text
+        hfp_cache_manager.cache_response(arxiv_paper_id, paper_content)
+
+    with span('parse.paper_page'):
+        page = PaperPage(paper_content)
+    return hf_paper_url, arxiv_paper_id, page
+
+
+def collect_llm_requests(papers, workers=1):
+    """Chat completion requests, keyed by '<namespace>:<completion key>', for the papers' uncached TLDRs and affiliations."""
+    def requests_for(paper):
+        requests = {}
+        pdf_url = paper['arXivPdf']
+        for namespace, name, request in [
+                ('tldr', paper['url'].split('/')[-1], tldr_request(paper['title'], paper['abstract'])),
+                ('affiliation', pdf_url.split('/')[-1], affiliation_request(get_pdf_text(pdf_url)))]:
+            # Completions of the legacy stores are taken over rather than requested again
+            adopt_legacy(namespace, name, request)
+            if not completion_cache(namespace).contains(request):
+                requests[f"{namespace}:{completion_key(request)}"] = request
+        return requests
+
+    requests = {}
+    for paper_requests in map_ordered(requests_for, papers, workers=workers):
+        requests.update(paper_requests)
+    return requests
+
+
+def process_paper(url, paper_date, title, paper_id):
+    return enrich_paper(fetch_paper(url, paper_date, title, paper_id))
+
+
+@traced('paper.fetch')
+def fetch_paper(url, paper_date, title, paper_id, refresh=False):
+    """Sheet row of a listed paper read from its page, without the LLM columns (tldr, affiliations)."""
+    hf_paper_url, arxiv_paper_id, page = fetch_paper_page(url, paper_id, refresh)
+
+    return dict(
+        notes="",
+        pick="",
+        title=title,
+        upvote=page.upvotes,
+        paperOfTheDay=paper_date if page.paper_of_the_day else None,
+        abstract=page.abstract,
+        date=paper_date,
+        arXiv=page.arxiv_link,
+        url=hf_paper_url,
+        arXivPdf=page.pdf_link
+    )
+
+
+@traced('paper.enrich')
+def enrich_paper(paper):
+    """Add the tldr and affiliations columns, after the title as in the sheet."""
+    # The legacy TLDR store is keyed by the id of the HF paper page
+    tldr = get_tldr(paper['title'], paper['abstract'], arxiv_id=paper['url'].split('/')[-1])
+    affiliations = post_process(get_author_affiliations(paper['arXivPdf']))
+    # Emergent Mind stats are fetched for the whole week afterwards, see emergentmind.fetch_all_stats
+
+    columns = list(paper.items())
+    return dict(columns[:3] + [('tldr', tldr), ('affiliations', affiliations)] + columns[3:])
+
+
+class PaperPage:
+    """Everything read from a Hugging Face paper page, extracted from a single parse."""
+
+    PAPER_OF_THE_DAY_TEXT = 'Paper of the day'
+    PDF_TEXT = 'View PDF'
+    ARXIV_TEXT = 'View arXiv page'
+
+    def __init__(self, html_content, parser=HTML_PARSER):
+        soup = BeautifulSoup(html_content, parser)
+
+        self.abstract = None
+        abstract_header = soup.find('h2', string='Abstract')
+        if abstract_header:
+            abstract_paragraph = abstract_header.find_next_sibling('p')
+            if abstract_paragraph:
+                self.abstract = abstract_paragraph.get_text(strip=True).replace('\n', ' ')
+        if self.abstract is None:
+            raise ValueError("Abstract not found in the given HTML content.")
+
+        # One walk over the links, first match wins as with extract_href_with_text
+        links = {}
+        texts = (self.PAPER_OF_THE_DAY_TEXT, self.PDF_TEXT, self.ARXIV_TEXT)
+        for link in soup.find_all('a'):
+            link_text = link.get_text()
+            for text in texts:
+                if text not in links and text in link_text:
+                    links[text] = link.get('href')
+            if len(links) == len(texts):
+                break
+
+        self.paper_of_the_day = links.get(self.PAPER_OF_THE_DAY_TEXT)
+        self.pdf_link = links.get(self.PDF_TEXT)
+        self.arxiv_link = links.get(self.ARXIV_TEXT)
+        if self.pdf_link is None or self.arxiv_link is None:
+            raise ValueError("arXiv link not found in the given HTML content.")
+
+        upvote_div = soup.find('div', class_='font-semibold text-orange-500')
+        try:
+            self.upvotes = int(upvote_div.text)
+        except:
+            self.upvotes = 0
 
 
 def extract_abstract(html_content):
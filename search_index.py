@@ -0,0 +1,268 @@
+import os
+import sqlite3
+import threading
+
+from cache import cache_dir, hf_cache_manager, hfp_cache_manager, tldr_cache_manager
+from concurrency import host_slot, OPENAI_HOST
+
+EMBEDDING_MODEL = 'text-embedding-3-small'
+# Texts per embeddings request, and characters of each text sent
+EMBEDDING_BATCH = 256
+EMBEDDING_CHARS = 8000
+# Rows of the embedding matrix scored at once, bounds the memory of a query
+SCORE_BLOCK = 65536
+
+
+def fts_query(query):
+    """The query with every word quoted, for input that is not valid FTS5 syntax."""
+    return ' '.join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+
+def top_k(matrix, queries, k, block=SCORE_BLOCK):
+    """Indexes and cosine scores of the k best rows of `matrix` for each row of `queries`.
+
+    Both are L2-normalized, so the dot product is the cosine. The matrix is scored `block` rows at a
+    time and only the running top k of each query is kept.
+    """
+    import numpy as np
+    best_rows = np.empty((len(queries), 0), dtype=np.int64)
+    best_scores = np.empty((len(queries), 0), dtype=np.float32)
+    for start in range(0, len(matrix), block):
+        scores = queries @ matrix[start:start + block].T
+        rows = np.broadcast_to(np.arange(start, start + scores.shape[1]), scores.shape)
+        scores = np.concatenate([best_scores, scores], axis=1)
+        rows = np.concatenate([best_rows, rows], axis=1)
+        if scores.shape[1] > k:
+            keep = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            scores = np.take_along_axis(scores, keep, axis=1)
+            rows = np.take_along_axis(rows, keep, axis=1)
+        best_scores, best_rows = scores, rows
+    order = np.argsort(-best_scores, axis=1)
+    return np.take_along_axis(best_rows, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+
+class SearchIndex:
+    """Full-text (SQLite FTS5) and optional semantic index of the cached papers.
+
+    update() only parses listings and paper pages that are new since the last update; papers
+    indexed before their TLDR was cached pick it up on a later update.
+    """
+
+    def __init__(self, db_file=None, embeddings_file=None):
+        self.db_file = db_file or cache_dir() / 'search.sqlite'
+        self.embeddings_file = embeddings_file or cache_dir() / 'search_embeddings.npy'
+        self.lock = threading.RLock()
+        self._connection = None
+
+    @property
+    def connection(self):
+        with self.lock:
+            if self._connection is None:
+                self.db_file.parent.mkdir(parents=True, exist_ok=True)
+                connection = sqlite3.connect(self.db_file, check_same_thread=False)
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.executescript("""
+                    CREATE TABLE IF NOT EXISTS listings (date TEXT PRIMARY KEY);
+                    CREATE TABLE IF NOT EXISTS listed (arxiv_id TEXT PRIMARY KEY, title TEXT, date TEXT);
+                    CREATE TABLE IF NOT EXISTS papers (rowid INTEGER PRIMARY KEY, arxiv_id TEXT UNIQUE NOT NULL,
+                        title TEXT, date TEXT, upvotes INTEGER, abstract TEXT, tldr TEXT);
+                    CREATE VIRTUAL TABLE IF NOT EXISTS papers_fts USING fts5(title, abstract, tldr,
+                        content='papers', content_rowid='rowid', tokenize='porter unicode61');
+                    CREATE TABLE IF NOT EXISTS embedded (arxiv_id TEXT PRIMARY KEY, row INTEGER NOT NULL);
+                    CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+                """)
+                self._connection = connection
+            return self._connection
+
+    def update_listings(self):
+        with self.lock:
+            done = {row[0] for row in self.connection.execute("SELECT date FROM listings")}
+        new_dates = [date for date in hf_cache_manager.keys() if date not in done]
+        if new_dates:
+            from process import parse_listing
+
+        for date in new_dates:
+            listing = parse_listing(hf_cache_manager.get_cached_response(date))
+            with self.lock:
+                # A paper listed on several days keeps the first one
+                self.connection.executemany(
+                    "INSERT INTO listed (arxiv_id, title, date) VALUES (?, ?, ?) "
+                    "ON CONFLICT (arxiv_id) DO UPDATE SET date = min(date, excluded.date)",
+                    [(paper_id.split('/')[-1], title, date) for title, paper_id in listing])
+                self.connection.execute("INSERT INTO listings (date) VALUES (?)", (date,))
+                self.connection.commit()
+        return len(new_dates)
+
+    def tldr_version(self):
+        """Changes whenever a TLDR is cached, so papers missing one are only rechecked when it could help."""
+        from llm_cache import completion_cache
+
+        versions = []
+        for manager in (completion_cache('tldr'), tldr_cache_manager):
+            if manager.db_file.exists():
+                versions.append(manager.connection.execute("SELECT COUNT(*), max(rowid) FROM cache").fetchone())
+        return repr(versions)
+
+    def cached_tldr(self, arxiv_id, title, abstract):
+        from llm import tldr_request
+        from llm_cache import completion_cache, completion_key
+
+        tldr = completion_cache('tldr').get_cached_response(completion_key(tldr_request(title, abstract)))
+        return tldr or tldr_cache_manager.get_cached_response(arxiv_id)
+
+    def update(self):
+        """Index the papers cached since the last update. Returns the number of papers added."""
+        self.update_listings()
+        with self.lock:
+            indexed = {row[0] for row in self.connection.execute("SELECT arxiv_id FROM papers")}
+            listed = {row[0]: row[1:] for row in self.connection.execute("SELECT arxiv_id, title, date FROM listed")}
+        new_ids = [arxiv_id for arxiv_id in hfp_cache_manager.keys() if arxiv_id not in indexed]
+        if new_ids:
+            from process import PaperPage
+
+        added = 0
+        for arxiv_id in new_ids:
+            try:
+                page = PaperPage(hfp_cache_manager.get_cached_response(arxiv_id))
+            except ValueError:
+                # Not a paper page, the pipeline skipped it too
+                continue
+            title, date = listed.get(arxiv_id, ('', None))
+            self.add(arxiv_id, title, date, page.upvotes, page.abstract,
+                     self.cached_tldr(arxiv_id, title, page.abstract))
+            added += 1
+
+        version = self.tldr_version()
+        with self.lock:
+            checked = self.connection.execute("SELECT value FROM meta WHERE name = 'tldr_version'").fetchone()
+            missing_tldr = [] if checked and checked[0] == version else self.connection.execute(
+                "SELECT rowid, arxiv_id, title, abstract FROM papers WHERE tldr IS NULL").fetchall()
+        for rowid, arxiv_id, title, abstract in missing_tldr:
+            tldr = self.cached_tldr(arxiv_id, title, abstract)
+            if tldr:
+                self.set_tldr(rowid, tldr)
+
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('tldr_version', ?)",
+                                    (version,))
+            self.connection.commit()
+        return added
+
+    def add(self, arxiv_id, title, date, upvotes, abstract, tldr):
+        with self.lock:
+            cursor = self.connection.execute(
+                "INSERT INTO papers (arxiv_id, title, date, upvotes, abstract, tldr) VALUES (?, ?, ?, ?, ?, ?)",
+                (arxiv_id, title, date, upvotes, abstract, tldr))
+            self.connection.execute("INSERT INTO papers_fts (rowid, title, abstract, tldr) VALUES (?, ?, ?, ?)",
+                                    (cursor.lastrowid, title, abstract, tldr or ''))
+
+    def set_tldr(self, rowid, tldr):
+        with self.lock:
+            title, abstract = self.connection.execute("SELECT title, abstract FROM papers WHERE rowid = ?",
+                                                      (rowid,)).fetchone()
+            # External content: the old row is removed from the index with its old values
+            self.connection.execute("INSERT INTO papers_fts (papers_fts, rowid, title, abstract, tldr) "
+                                    "VALUES ('delete', ?, ?, ?, '')", (rowid, title, abstract))
+            self.connection.execute("UPDATE papers SET tldr = ? WHERE rowid = ?", (tldr, rowid))
+            self.connection.execute("INSERT INTO papers_fts (rowid, title, abstract, tldr) VALUES (?, ?, ?, ?)",
+                                    (rowid, title, abstract, tldr))
+
+    def size(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM papers").fetchone()[0]
+
+    def search(self, query, since=None, limit=20):
+        """Best matches by BM25 as dicts, `query` is FTS5 syntax ("speculative decoding", LoRA OR adapter)."""
+        sql = ("SELECT p.arxiv_id, p.title, p.date, p.upvotes, "
+               "snippet(papers_fts, -1, '[', ']', '...', 16), bm25(papers_fts) "
+               "FROM papers_fts JOIN papers p ON p.rowid = papers_fts.rowid "
+               "WHERE papers_fts MATCH ? AND (? IS NULL OR p.date >= ?) ORDER BY bm25(papers_fts) LIMIT ?")
+        with self.lock:
+            try:
+                rows = self.connection.execute(sql, (query, since, since, limit)).fetchall()
+            except sqlite3.OperationalError:
+                rows = self.connection.execute(sql, (fts_query(query), since, since, limit)).fetchall()
+        return [dict(arxiv_id=arxiv_id, title=title, date=date, upvotes=upvotes, snippet=snippet, score=-score)
+                for arxiv_id, title, date, upvotes, snippet, score in rows]
+
+    def embed(self, texts):
+        from llm import get_client
+
+        import numpy as np
+        with host_slot(OPENAI_HOST):
+            response = get_client().embeddings.create(model=EMBEDDING_MODEL,
+                                                      input=[text[:EMBEDDING_CHARS] for text in texts])
+        vectors = np.array([item.embedding for item in response.data], dtype=np.float32)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    def load_embeddings(self):
+        import numpy as np
+        if self.embeddings_file.exists():
+            return np.load(self.embeddings_file)
+        return None
+
+    def update_embeddings(self):
+        """Embed the papers indexed since the last call, in batches. Returns the number embedded."""
+        import numpy as np
+        with self.lock:
+            pending = self.connection.execute(
+                "SELECT arxiv_id, title, coalesce(tldr, abstract) FROM papers "
+                "WHERE arxiv_id NOT IN (SELECT arxiv_id FROM embedded) ORDER BY rowid").fetchall()
+        if not pending:
+            return 0
+
+        with self.lock:
+            rows = self.connection.execute("SELECT coalesce(max(row) + 1, 0) FROM embedded").fetchone()[0]
+        matrix = self.load_embeddings()
+        # Rows past the last recorded one were saved by a run that crashed before recording them, drop them
+        blocks = [] if matrix is None or rows == 0 else [matrix[:rows]]
+        for start in range(0, len(pending), EMBEDDING_BATCH):
+            batch = pending[start:start + EMBEDDING_BATCH]
+            blocks.append(self.embed([f"{title}\n\n{text}" for _, title, text in batch]))
+        matrix = np.concatenate(blocks)
+
+        # Write the matrix before recording its rows, a crash in between leaves unrecorded rows that the next
+        # update drops and embeds again
+        temporary = self.embeddings_file.with_suffix('.tmp.npy')
+        np.save(temporary, matrix)
+        os.replace(temporary, self.embeddings_file)
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO embedded (arxiv_id, row) VALUES (?, ?)",
+                                        [(arxiv_id, rows + i) for i, (arxiv_id, _, _) in enumerate(pending)])
+            self.connection.commit()
+        return len(pending)
+
+    def semantic_search(self, queries, since=None, limit=20):
+        """Nearest papers by embedding cosine for each query, as lists of dicts."""
+        matrix = self.load_embeddings()
+        if matrix is None:
+            return [[] for _ in queries]
+        with self.lock:
+            papers = {row: (arxiv_id, title, date, upvotes) for row, arxiv_id, title, date, upvotes in
+                      self.connection.execute("SELECT e.row, p.arxiv_id, p.title, p.date, p.upvotes "
+                                              "FROM embedded e JOIN papers p USING (arxiv_id)")}
+        # Over-fetch when filtering by date, older papers are dropped after scoring
+        k = min(len(matrix), limit * 4 if since else limit)
+        rows, scores = top_k(matrix, self.embed(queries), k)
+
+        results = []
+        for query_rows, query_scores in zip(rows, scores):
+            matches = []
+            for row, score in zip(query_rows, query_scores):
+                if int(row) not in papers:
+                    # Saved by an update that crashed before recording it
+                    continue
+                arxiv_id, title, date, upvotes = papers[int(row)]
+                if since and (date is None or date < since):
+                    continue
+                matches.append(dict(arxiv_id=arxiv_id, title=title, date=date, upvotes=upvotes,
+                                    score=float(score)))
+            results.append(matches[:limit])
+        return results
+
+
+def print_results(results):
+    for result in results:
+        print(f"{result['score']:>7.3f}  {result['date'] or '':<10}  {result['arxiv_id']:<12}  {result['title']}")
+        if result.get('snippet'):
+            print(f"{'':>9}{result['snippet']}")
@@ -0,0 +1,404 @@
+"""Local stand-ins for remote APIs, to run the pipeline without network access or cost.
+
+    python stubs.py --port 8089
+    OPENAI_BASE_URL=http://127.0.0.1:8089/v1 OPENAI_API_KEY=stub python main.py retrieve --batch
+
+The Sheets stand-in listens on the next port, sheets_service() builds a client for it.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import math
+import re
+import struct
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+
+def stub_id(prefix):
+    return f"{prefix}-{uuid.uuid4().hex[:12]}"
+
+
+def stub_completion(body):
+    """A chat completion shaped like the real one, with content the pipeline can post-process."""
+    system = body['messages'][0]['content']
+    prompt = body['messages'][-1]['content']
+    if 'affiliations' in system:
+        content = '["Stub University", "Stub Institute"]'
+    else:
+        content = f"Stub response ({len(prompt)} prompt characters)."
+    prompt_tokens = sum(len(message['content']) for message in body['messages']) // 4
+    completion_tokens = len(content) // 4
+    return dict(
+        id=stub_id('chatcmpl'),
+        object='chat.completion',
+        created=int(time.time()),
+        model=body['model'],
+        choices=[dict(index=0, message=dict(role='assistant', content=content), finish_reason='stop')],
+        usage=dict(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                   total_tokens=prompt_tokens + completion_tokens),
+    )
+
+
+STUB_EMBEDDING_DIMENSIONS = 256
+
+
+def stub_embedding(text):
+    """Hashed bag of words, texts sharing words get similar vectors so semantic search behaves sensibly."""
+    vector = [0.0] * STUB_EMBEDDING_DIMENSIONS
+    for word in re.findall(r'\w+', text.lower()):
+        vector[int(hashlib.md5(word.encode('utf-8')).hexdigest(), 16) % STUB_EMBEDDING_DIMENSIONS] += 1.0
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+def stub_embeddings(body):
+    inputs = body['input'] if isinstance(body['input'], list) else [body['input']]
+    data = []
+    for index, text in enumerate(inputs):
+        embedding = stub_embedding(text)
+        if body.get('encoding_format') == 'base64':
+            # The SDK asks for base64 float32 by default and decodes it itself
+            embedding = base64.b64encode(struct.pack(f"<{len(embedding)}f", *embedding)).decode('ascii')
+        data.append(dict(object='embedding', index=index, embedding=embedding))
+    tokens = sum(len(text) for text in inputs) // 4
+    return dict(object='list', data=data, model=body['model'], usage=dict(prompt_tokens=tokens, total_tokens=tokens))
+
+
+class OpenAIStub:
+    """Chat completions, embeddings, and the files and batches endpoints used by llm_batch.
+
+    Batches finish on first poll. Batch requests whose custom_id is in `failures` ({custom_id: status code})
+    go to the batch's error file instead of its output.
+    """
+
+    def __init__(self, latency=0.0, failures=None):
+        self.latency = latency
+        self.failures = failures or {}
+        self.files = {}
+        self.batches = {}
+        self.lock = threading.RLock()
+        self.calls = 0
+
+    def file_object(self, file_id, purpose, filename):
+        return dict(id=file_id, object='file', bytes=len(self.files[file_id]), created_at=int(time.time()),
+                    filename=filename, purpose=purpose, status='processed')
+
+    def add_file(self, content, purpose, filename):
+        file_id = stub_id('file')
+        with self.lock:
+            self.files[file_id] = content
+        return self.file_object(file_id, purpose, filename)
+
+    def run_batch(self, batch):
+        lines, errors = [], []
+        for line in self.files[batch['input_file_id']].decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            status = self.failures.get(request['custom_id'])
+            if status is not None:
+                errors.append(json.dumps(dict(
+                    id=stub_id('batch_req'),
+                    custom_id=request['custom_id'],
+                    response=dict(status_code=status, request_id=stub_id('req'),
+                                  body=dict(error=dict(message="Stub failure", type='server_error'))),
+                    error=None,
+                )))
+                continue
+            lines.append(json.dumps(dict(
+                id=stub_id('batch_req'),
+                custom_id=request['custom_id'],
+                response=dict(status_code=200, request_id=stub_id('req'), body=stub_completion(request['body'])),
+                error=None,
+            )))
+        output = self.add_file(('\n'.join(lines) + '\n').encode('utf-8'), 'batch_output', 'output.jsonl')
+        error_file = self.add_file(('\n'.join(errors) + '\n').encode('utf-8'), 'batch_output', 'errors.jsonl') \
+            if errors else None
+        batch.update(status='completed', output_file_id=output['id'], completed_at=int(time.time()),
+                     error_file_id=error_file['id'] if error_file else None,
+                     request_counts=dict(total=len(lines) + len(errors), completed=len(lines), failed=len(errors)))
+
+    def handle(self, method, path, query, headers, body):
+        """Returns (status, payload), payload is bytes or a JSON-serializable object."""
+        time.sleep(self.latency)
+        with self.lock:
+            self.calls += 1
+
+        if method == 'POST' and path.endswith('/chat/completions'):
+            return 200, stub_completion(json.loads(body))
+
+        if method == 'POST' and path.endswith('/embeddings'):
+            return 200, stub_embeddings(json.loads(body))
+
+        if method == 'POST' and path.endswith('/files'):
+            message = BytesParser(policy=default_policy).parsebytes(
+                f"Content-Type: {headers['Content-Type']}\r\n\r\n".encode('ascii') + body)
+            fields = {part.get_param('name', header='content-disposition'): part for part in message.iter_parts()}
+            upload = fields['file']
+            return 200, self.add_file(upload.get_payload(decode=True), fields['purpose'].get_content().strip(),
+                                      upload.get_filename())
+
+        match = re.search(r'/files/([^/]+)/content$', path)
+        if method == 'GET' and match:
+            return (200, self.files[match.group(1)]) if match.group(1) in self.files else (404, {})
+
+        if method == 'POST' and path.endswith('/batches'):
+            request = json.loads(body)
+            batch = dict(id=stub_id('batch'), object='batch', endpoint=request['endpoint'],
+                         input_file_id=request['input_file_id'], completion_window=request['completion_window'],
+                         status='in_progress', created_at=int(time.time()), output_file_id=None, error_file_id=None,
+                         request_counts=dict(total=0, completed=0, failed=0))
+            with self.lock:
+                self.batches[batch['id']] = batch
+            return 200, batch
+
+        match = re.search(r'/batches/([^/]+)$', path)
+        if method == 'GET' and match:
+            batch = self.batches.get(match.group(1))
+            if batch is None:
+                return 404, {}
+            with self.lock:
+                if batch['status'] == 'in_progress':
+                    self.run_batch(batch)
+            return 200, batch
+
+        return 404, dict(error=dict(message=f"stub does not implement {method} {path}"))
+
+
+def column_index(letters):
+    index = 0
+    for letter in letters.upper():
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index - 1
+
+
+def parse_a1(a1_range):
+    """(sheet, start_row, start_col, end_row, end_col) of an A1 range, ends exclusive and None when open."""
+    sheet, _, cells = a1_range.partition('!')
+    if not cells:
+        return sheet, 0, 0, None, None
+    bounds = []
+    for part in cells.split(':'):
+        match = re.match(r'([A-Za-z]*)(\d*)$', part)
+        col = column_index(match.group(1)) if match.group(1) else None
+        row = int(match.group(2)) - 1 if match.group(2) else None
+        bounds.append((row, col))
+    (start_row, start_col), (end_row, end_col) = bounds[0], bounds[-1]
+    return (sheet, start_row or 0, start_col or 0,
+            None if end_row is None else end_row + 1, None if end_col is None else end_col + 1)
+
+
+def display_value(cell):
+    """What values.get returns for a cell: formatted value, HYPERLINK formulas show their label."""
+    value = cell.get('userEnteredValue', {})
+    if 'formulaValue' in value:
+        match = re.match(r'=HYPERLINK\(".*?",\s*"(.*)"\)$', value['formulaValue'])
+        return match.group(1) if match else value['formulaValue']
+    if 'numberValue' in value:
+        number = value['numberValue']
+        return str(int(number)) if float(number).is_integer() else str(number)
+    if 'boolValue' in value:
+        return 'TRUE' if value['boolValue'] else 'FALSE'
+    return value.get('stringValue', '')
+
+
+def merge_fields(target, source, fields):
+    if fields == '*':
+        target.update(source)
+        return
+    for field in fields.split(','):
+        path = field.strip().split('.')
+        src, dst = source, target
+        for key in path[:-1]:
+            src = src.get(key, {})
+            dst = dst.setdefault(key, {})
+        if path[-1] in src:
+            dst[path[-1]] = src[path[-1]]
+
+
+class SheetsStub:
+    """An in-memory Sheets v4 API covering the calls gsheet makes. Every request body is kept in `log`."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.spreadsheets = {}
+        self.log = []
+        self.lock = threading.RLock()
+
+    def grid(self, spreadsheet_id):
+        return self.spreadsheets[spreadsheet_id]['grid']
+
+    def last_row(self, grid):
+        return max((row for row, _ in grid), default=-1)
+
+    def set_rows(self, grid, start_row, start_col, rows, fields='*'):
+        for r, row in enumerate(rows):
+            for c, cell in enumerate(row.get('values', [])):
+                merge_fields(grid.setdefault((start_row + r, start_col + c), {}), cell, fields)
+
+    def set_values(self, grid, a1_range, values):
+        _, start_row, start_col, _, _ = parse_a1(a1_range)
+        for r, row in enumerate(values):
+            for c, value in enumerate(row):
+                if isinstance(value, str) and value.startswith('='):
+                    entered = {'formulaValue': value}
+                elif isinstance(value, bool):
+                    entered = {'boolValue': value}
+                elif isinstance(value, (int, float)):
+                    entered = {'numberValue': value}
+                elif value is None:
+                    continue
+                else:
+                    entered = {'stringValue': str(value)}
+                grid.setdefault((start_row + r, start_col + c), {})['userEnteredValue'] = entered
+
+    def get_values(self, grid, a1_range):
+        _, start_row, start_col, end_row, end_col = parse_a1(a1_range)
+        end_row = self.last_row(grid) + 1 if end_row is None else end_row
+        end_col = max((col for _, col in grid), default=-1) + 1 if end_col is None else end_col
+        values = []
+        for row in range(start_row, end_row):
+            values.append([display_value(grid.get((row, col), {})) for col in range(start_col, end_col)])
+            while values[-1] and values[-1][-1] == '':
+                values[-1].pop()
+        while values and not values[-1]:
+            values.pop()
+        return dict(range=a1_range, majorDimension='ROWS', values=values)
+
+    def apply(self, spreadsheet_id, request):
+        grid = self.grid(spreadsheet_id)
+        if 'updateCells' in request:
+            update = request['updateCells']
+            self.set_rows(grid, update['range']['startRowIndex'], update['range']['startColumnIndex'],
+                          update['rows'], update['fields'])
+        elif 'appendCells' in request:
+            append = request['appendCells']
+            self.set_rows(grid, self.last_row(grid) + 1, 0, append['rows'], append['fields'])
+        elif 'repeatCell' in request:
+            repeat = request['repeatCell']
+            cell_range = repeat['range']
+            end_row = cell_range.get('endRowIndex', self.last_row(grid) + 1)
+            for row in range(cell_range.get('startRowIndex', 0), end_row):
+                for col in range(cell_range['startColumnIndex'], cell_range['endColumnIndex']):
+                    merge_fields(grid.setdefault((row, col), {}), repeat['cell'], repeat['fields'])
+        # Dimension and other property updates do not affect the stored values
+
+    def handle(self, method, path, query, headers, body):
+        time.sleep(self.latency)
+        request = json.loads(body) if body else None
+        with self.lock:
+            self.log.append(dict(method=method, path=path, query=query, bytes=len(body), body=request))
+
+            if method == 'POST' and path == '/v4/spreadsheets':
+                spreadsheet_id = stub_id('sheet')
+                self.spreadsheets[spreadsheet_id] = dict(properties=request.get('properties', {}), grid={})
+                for sheet in request.get('sheets', []):
+                    for data in sheet.get('data', []):
+                        self.set_rows(self.grid(spreadsheet_id), data.get('startRow', 0),
+                                      data.get('startColumn', 0), data.get('rowData', []))
+                return 200, dict(spreadsheetId=spreadsheet_id, properties=request.get('properties', {}))
+
+            match = re.match(r'/v4/spreadsheets/([^/:]+)(.*)$', path)
+            if not match or match.group(1) not in self.spreadsheets:
+                return 404, dict(error=dict(code=404, message=f"stub does not know {method} {path}"))
+            spreadsheet_id, rest = match.groups()
+            grid = self.grid(spreadsheet_id)
+
+            if method == 'POST' and rest == ':batchUpdate':
+                for update in request['requests']:
+                    self.apply(spreadsheet_id, update)
+                return 200, dict(spreadsheetId=spreadsheet_id, replies=[{} for _ in request['requests']])
+            if method == 'GET' and rest == '/values:batchGet':
+                return 200, dict(spreadsheetId=spreadsheet_id,
+                                 valueRanges=[self.get_values(grid, a1) for a1 in query.get('ranges', [])])
+            if method == 'POST' and rest == '/values:batchUpdate':
+                for data in request['data']:
+                    self.set_values(grid, data['range'], data['values'])
+                return 200, dict(spreadsheetId=spreadsheet_id, totalUpdatedCells=sum(
+                    len(row) for data in request['data'] for row in data['values']))
+            match = re.match(r'/values/([^:]+)(:append)?$', rest)
+            if match and match.group(2) and method == 'POST':
+                start = self.last_row(grid) + 1
+                sheet = parse_a1(match.group(1))[0]
+                self.set_values(grid, f"{sheet}!A{start + 1}", request['values'])
+                return 200, dict(spreadsheetId=spreadsheet_id, updates=dict(updatedRows=len(request['values'])))
+            if match and method == 'PUT':
+                self.set_values(grid, match.group(1), request['values'])
+                return 200, dict(spreadsheetId=spreadsheet_id, updatedRange=match.group(1))
+            if match and method == 'GET':
+                return 200, self.get_values(grid, match.group(1))
+
+        return 404, dict(error=dict(code=404, message=f"stub does not implement {method} {path}"))
+
+
+def sheets_service(base_url):
+    """A googleapiclient Sheets service talking to a SheetsStub, built from the bundled discovery document."""
+    import httplib2
+    from googleapiclient.discovery import build
+
+    return build('sheets', 'v4', http=httplib2.Http(), static_discovery=True,
+                 client_options={'api_endpoint': base_url + '/'})
+
+
+def make_handler(stub):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def respond(self, method):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            url = urlsplit(self.path)
+            status, payload = stub.handle(method, unquote(url.path), parse_qs(url.query), self.headers, body)
+            data = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/octet-stream' if isinstance(payload, bytes)
+                             else 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self.respond('GET')
+
+        def do_POST(self):
+            self.respond('POST')
+
+        def do_PUT(self):
+            self.respond('PUT')
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(stub, port=0):
+    """Start the stub on a background thread. Returns (server, base_url)."""
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(stub))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve local stand-ins for remote APIs.")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    args = parser.parse_args()
+
+    server, base_url = serve(OpenAIStub(latency=args.latency), args.port)
+    sheets_server, sheets_url = serve(SheetsStub(latency=args.latency), args.port + 1)
+    print(f"OpenAI stub: OPENAI_BASE_URL={base_url}/v1")
+    print(f"Sheets stub: {sheets_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        sheets_server.shutdown()
@@ -0,0 +1,79 @@
+"""Payload checks of the weekly sheet against the local Sheets stub (stubs.SheetsStub)."""
+import re
+
+import pytest
+
+from gsheet import GSheet, GSheetReader
+from main import WRAP_COLUMNS, build_sheet
+from stubs import SheetsStub, serve, sheets_service
+
+
+def make_papers(count):
+    return [dict(notes="", pick="", title=f"Paper {i} title", tldr=f"TLDR of paper {i}.",
+                 affiliations=f"University {i}", upvote=count - i, paperOfTheDay=None,
+                 abstract=f"Abstract of paper {i}. " * 20, date='2026-10-05',
+                 arXiv=f"https://arxiv.org/abs/2610.{i:05d}", url=f"https://huggingface.co/papers/2610.{i:05d}",
+                 arXivPdf=f"https://arxiv.org/pdf/2610.{i:05d}")
+            for i in range(count)]
+
+
+@pytest.fixture
+def sheets():
+    stub = SheetsStub()
+    server, url = serve(stub)
+    yield stub, sheets_service(url)
+    server.shutdown()
+
+
+def creates(stub):
+    return [entry for entry in stub.log if entry['method'] == 'POST' and entry['path'] == '/v4/spreadsheets']
+
+
+def batch_updates(stub):
+    return [entry for entry in stub.log
+            if entry['method'] == 'POST' and re.match(r'/v4/spreadsheets/[^/]+:batchUpdate$', entry['path'])]
+
+
+def test_week_is_one_create_and_one_batch_update(sheets):
+    stub, service = sheets
+    build_sheet(make_papers(50), "Paper Review: 2026-10-05", service=service)
+
+    assert len(creates(stub)) == 1
+    assert len(batch_updates(stub)) <= 1
+    assert len(stub.log) == len(creates(stub)) + len(batch_updates(stub))
+
+
+def test_chunked_rows_read_back_intact(sheets):
+    stub, service = sheets
+    papers = make_papers(40)
+    abstracts = [paper['abstract'] for paper in papers]
+    expected = [dict(paper) for paper in papers]
+
+    # The steps of main.build_sheet, committed with a limit small enough to split the rows
+    gsheet = GSheet(papers, "Paper Review: 2026-10-05", service=service, deferred=True)
+    gsheet.create_spreadsheet()
+    gsheet.insert_clickable_urls(gsheet.titles, gsheet.pdf_urls)
+    gsheet.insert_notes(gsheet.abstracts, 'tldr')
+    gsheet.wrap_text_in_columns(WRAP_COLUMNS, "WRAP")
+    spreadsheet_id = gsheet.commit(max_request_bytes=8_000)
+
+    assert len(creates(stub)) == 1
+    appended = [request for entry in batch_updates(stub) for request in entry['body']['requests']
+                if 'appendCells' in request]
+    assert len(appended) > 1
+    assert all(entry['bytes'] <= 8_000 for entry in stub.log)
+
+    rows = GSheetReader(spreadsheet_id, service=service).read_sheet()
+    assert [row['title'] for row in rows] == [paper['title'] for paper in expected]
+    assert [row['tldr'] for row in rows] == [paper['tldr'] for paper in expected]
+    assert [int(row['upvote']) for row in rows] == [paper['upvote'] for paper in expected]
+    assert [row['arXiv'] for row in rows] == [paper['arXiv'] for paper in expected]
+
+    grid = stub.grid(spreadsheet_id)
+    columns = gsheet.column_names
+    for row, paper in enumerate(expected, start=1):
+        title = grid[(row, columns.index('title'))]['userEnteredValue']['formulaValue']
+        assert title == f'=HYPERLINK("{paper["arXivPdf"]}", "{paper["title"]}")'
+        assert grid[(row, columns.index('tldr'))]['note'] == abstracts[row - 1]
+        for column in WRAP_COLUMNS:
+            assert grid[(row, columns.index(column))]['userEnteredFormat']['wrapStrategy'] == 'WRAP'
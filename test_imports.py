@@ -0,0 +1,12 @@
+"""The quick commands of main.py must not import the heavy clients, see bench.bench_imports."""
+import pytest
+
+from bench import STARTUP_COMMANDS, heavy_imports, import_times
+
+
+@pytest.mark.parametrize('args', STARTUP_COMMANDS, ids=' '.join)
+def test_quick_commands_import_no_heavy_package(args, tmp_path):
+    _, times = import_times(args, tmp_path)
+
+    assert times, "python -X importtime reported no imports"
+    assert heavy_imports(times) == []
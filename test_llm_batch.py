@@ -0,0 +1,80 @@
+"""Batch API round trips against the local OpenAI stub (stubs.OpenAIStub)."""
+import json
+
+import pytest
+from openai import OpenAI
+
+import llm
+import llm_cache
+from llm import affiliation_request, tldr_request
+from llm_batch import cache_batch_output, run_batch
+from llm_cache import completion_cache, completion_key
+from stubs import OpenAIStub, serve
+
+
+def make_requests():
+    pending = [('tldr', tldr_request(f"Paper {i} title", f"Abstract of paper {i}.")) for i in range(3)]
+    pending += [('affiliation', affiliation_request(f"First page of paper {i}.")) for i in range(2)]
+    return {f"{namespace}:{completion_key(request)}": request for namespace, request in pending}
+
+
+@pytest.fixture
+def caches(tmp_path, monkeypatch):
+    # Completion stores under a scratch .cache, opened afresh for the test
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(llm_cache, '_caches', {})
+
+
+def serve_openai(stub):
+    server, url = serve(stub)
+    llm.set_client(OpenAI(base_url=f"{url}/v1", api_key='stub'))
+    return server
+
+
+@pytest.fixture
+def openai_stub(caches):
+    stub = OpenAIStub()
+    server = serve_openai(stub)
+    yield stub
+    llm.set_client(None)
+    server.shutdown()
+
+
+def test_every_request_lands_in_its_namespace_cache(openai_stub):
+    requests = make_requests()
+
+    assert run_batch(requests, poll_seconds=0) == len(requests)
+    for custom_id, request in requests.items():
+        namespace, key = custom_id.split(':', 1)
+        assert key == completion_key(request)
+        assert completion_cache(namespace).contains(request)
+        assert completion_cache(namespace).lookup(request)
+
+
+def test_error_file_lines_count_as_failed(caches, capsys):
+    requests = make_requests()
+    failed_id = next(iter(requests))
+    server = serve_openai(OpenAIStub(failures={failed_id: 500}))
+    try:
+        assert run_batch(requests, poll_seconds=0) == len(requests) - 1
+    finally:
+        llm.set_client(None)
+        server.shutdown()
+
+    assert f"cached {len(requests) - 1} responses, 1 failed" in capsys.readouterr().out
+    namespace = failed_id.split(':', 1)[0]
+    assert not completion_cache(namespace).contains(requests[failed_id])
+
+
+def test_non_200_output_line_counts_as_failed(caches):
+    request = tldr_request("Title", "Abstract")
+    key = completion_key(request)
+    output = '\n'.join(json.dumps(line) for line in [
+        dict(custom_id=f"tldr:{key}", error=None,
+             response=dict(status_code=200, body=dict(choices=[dict(message=dict(content="A TLDR."))]))),
+        dict(custom_id=f"tldr:{'0' * 64}", error=None,
+             response=dict(status_code=400, body=dict(error=dict(message="Bad request")))),
+    ])
+
+    assert cache_batch_output(output) == (1, 1)
+    assert completion_cache('tldr').lookup(request) == "A TLDR."
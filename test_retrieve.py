@@ -0,0 +1,167 @@
+"""Retrieve, --sync, backfill and review runs against a fake Hugging Face site and the local stubs."""
+from types import SimpleNamespace
+from urllib.parse import urlparse
+
+import pytest
+from openai import OpenAI
+
+import cache
+import dataset
+import gsheet
+import http_client
+import llm
+import llm_cache
+import main
+import pdf
+import process
+from gsheet import GSheetReader
+from stubs import OpenAIStub, SheetsStub, serve, sheets_service
+from utils import append_tsv, read_tsv_dict
+
+DAYS = ['2026-10-05', '2026-10-06', '2026-10-07', '2026-10-08', '2026-10-09']
+WORDS = "sparse attention kernels diffusion policy reward models retrieval agents tokenizer speculative decoding " \
+        "quantized adapters robot manipulation video generation protein folding theorem proving compiler".split()
+
+
+def abstract_of(paper_id):
+    # Distinct words per paper, so only papers given the same text are near-duplicates
+    seed = int(paper_id.split('.')[-1])
+    return ' '.join(WORDS[(seed * 7 + i * 3) % len(WORDS)] + str(seed + i) for i in range(40))
+
+
+class HuggingFaceSite:
+    """Listings and paper pages as served by huggingface.co/papers, editable between runs."""
+
+    def __init__(self):
+        self.listings = {}
+        self.upvotes = {}
+        self.abstracts = {}
+
+    def get(self, url, params=None, **kwargs):
+        if params and 'date' in params:
+            papers = ''.join(f'<div class="from-gray-50-to-white"><h3><a href="/papers/{paper_id}">Paper {paper_id}</a>'
+                             f'</h3></div>' for paper_id in self.listings.get(params['date'], []))
+            return SimpleNamespace(text=f"<html><body>{papers}</body></html>")
+        paper_id = urlparse(url).path.split('/')[-1]
+        abstract = self.abstracts.get(paper_id) or abstract_of(paper_id)
+        return SimpleNamespace(text=(
+            f'<html><body><h2>Abstract</h2><p>{abstract}</p>'
+            f'<div class="font-semibold text-orange-500">{self.upvotes.get(paper_id, 1)}</div>'
+            f'<a href="https://arxiv.org/pdf/{paper_id}">View PDF</a>'
+            f'<a href="https://arxiv.org/abs/{paper_id}">View arXiv page</a></body></html>'))
+
+
+@pytest.fixture
+def site(tmp_path, monkeypatch):
+    # Caches, journal, dataset and spreadsheet list under a scratch directory
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / '.data').mkdir()
+    monkeypatch.setattr(cache, '_managers', {})
+    monkeypatch.setattr(llm_cache, '_caches', {})
+    for name in ['hf_cache_manager', 'hfp_cache_manager']:
+        monkeypatch.setattr(process, name, cache.cache_manager(name))
+    monkeypatch.setattr(main, 'get_last_monday', lambda: (DAYS, DAYS[0]))
+
+    hugging_face = HuggingFaceSite()
+    monkeypatch.setattr(http_client, 'get', hugging_face.get)
+    # First pages of the PDFs, the affiliations are asked of the OpenAI stub
+    monkeypatch.setattr(pdf, 'get_pdf_text', lambda arxiv_url: f"First page of {arxiv_url}")
+    monkeypatch.setattr(llm, 'get_pdf_text', pdf.get_pdf_text)
+
+    openai_server, openai_url = serve(OpenAIStub())
+    llm.set_client(OpenAI(base_url=f"{openai_url}/v1", api_key='stub'))
+    sheets_server, sheets_url = serve(SheetsStub())
+    service = sheets_service(sheets_url)
+    monkeypatch.setattr(gsheet, 'get_service', lambda: service)
+    yield hugging_face, service
+    llm.set_client(None)
+    openai_server.shutdown()
+    sheets_server.shutdown()
+
+
+def sheet_upvotes(service):
+    spreadsheet_id = read_tsv_dict(main.SPREADSHEET_FILE)[DAYS[0]]
+    rows = GSheetReader(spreadsheet_id, service).read_sheet()
+    return [(row['arXiv'].split('/')[-1], int(row['upvote'])) for row in rows]
+
+
+def test_sync_brings_new_papers_and_upvotes_to_the_sheet(site):
+    hugging_face, service = site
+    hugging_face.listings = {DAYS[0]: ['2610.00001', '2610.00002']}
+    hugging_face.upvotes = {'2610.00001': 20, '2610.00002': 10}
+    main.retrieve_papers(stats=False)
+    assert sheet_upvotes(service) == [('2610.00001', 20), ('2610.00002', 10)]
+
+    # Later in the week: a paper gains upvotes and another is listed, on a day already scraped too
+    hugging_face.upvotes['2610.00002'] = 30
+    hugging_face.listings[DAYS[0]].append('2610.00003')
+    hugging_face.upvotes['2610.00003'] = 5
+    main.retrieve_papers(sync=True, stats=False)
+
+    assert sheet_upvotes(service) == [('2610.00001', 20), ('2610.00002', 30), ('2610.00003', 5)]
+
+
+def test_sync_matches_another_copy_of_a_near_duplicate(site):
+    hugging_face, service = site
+    hugging_face.listings = {DAYS[0]: ['2610.00001'], DAYS[1]: ['2610.00002']}
+    hugging_face.abstracts = {'2610.00001': abstract_of('2610.00009'), '2610.00002': abstract_of('2610.00009')}
+    hugging_face.upvotes = {'2610.00001': 20, '2610.00002': 10}
+    main.retrieve_papers(stats=False)
+    assert sheet_upvotes(service) == [('2610.00001', 20)]
+
+    # The other copy now has more upvotes and is the one dedup keeps, its row is the first copy's
+    hugging_face.upvotes['2610.00002'] = 40
+    main.retrieve_papers(sync=True, stats=False)
+
+    assert sheet_upvotes(service) == [('2610.00001', 40)]
+
+
+def test_retrieve_takes_over_legacy_completions(site):
+    hugging_face, service = site
+    hugging_face.listings = {DAYS[0]: ['2610.00001']}
+    # Stored by arXiv id before completions were keyed by request
+    cache.cache_manager('tldr_cache_manager').cache_response('2610.00001', "Legacy TLDR.")
+    cache.cache_manager('affiliation_cache_manager').cache_response('2610.00001', '["Legacy University"]')
+    main.retrieve_papers(stats=False)
+
+    spreadsheet_id = read_tsv_dict(main.SPREADSHEET_FILE)[DAYS[0]]
+    [row] = GSheetReader(spreadsheet_id, service).read_sheet()
+    assert (row['tldr'], row['affiliations']) == ("Legacy TLDR.", "Legacy University")
+
+
+def test_backfill_keeps_a_paper_listed_on_several_days_once(site):
+    hugging_face, _ = site
+    hugging_face.listings = {DAYS[0]: ['2610.00001', '2610.00002'], DAYS[2]: ['2610.00001', '2610.00003'],
+                             DAYS[3]: ['2610.00003']}
+    main.backfill(DAYS[0], DAYS[0])
+    # A day stored by the first run, and days of the same week retrieved side by side
+    main.backfill(DAYS[0], DAYS[3], workers=3)
+
+    week = dataset.read(weeks=[DAYS[0]], columns=['arXiv'])
+    assert sorted(week['arXiv'].str.split('/').str[-1]) == ['2610.00001', '2610.00002', '2610.00003']
+
+
+def paper_row(paper_id, day, upvote, notes="", pick=""):
+    return dict(notes=notes, pick=pick, title=f"Paper {paper_id}", tldr="A TLDR.", affiliations="Stub University",
+                upvote=upvote, paperOfTheDay=None, abstract=abstract_of(paper_id), date=day,
+                arXiv=f"https://arxiv.org/abs/{paper_id}", url=f"https://huggingface.co/papers/{paper_id}",
+                arXivPdf=f"https://arxiv.org/pdf/{paper_id}")
+
+
+def test_review_takes_each_marked_paper_once(site, monkeypatch):
+    _, service = site
+    # 2610.00001 is stored for two days of the week, 2610.00003 is in the sheet only
+    dataset.write_day(DAYS[0], [paper_row('2610.00001', DAYS[0], 30), paper_row('2610.00002', DAYS[0], 20)])
+    dataset.write_day(DAYS[2], [paper_row('2610.00001', DAYS[2], 30)])
+    sheet = [paper_row('2610.00001', DAYS[0], 30, notes="Good", pick="x"), paper_row('2610.00002', DAYS[0], 20),
+             paper_row('2610.00003', DAYS[2], 10, notes="Also good")]
+    append_tsv(main.SPREADSHEET_FILE, [DAYS[0], main.build_sheet(sheet, "Paper Review", service=service)])
+
+    reviews = []
+    monkeypatch.setattr(main, 'generate_review_aux', lambda picked, reviewed, *args: reviews.append((picked, reviewed)))
+    main.generate_review()
+
+    [(picked, reviewed)] = reviews
+    assert [paper['arXiv'][-10:] for paper in picked] == ['2610.00001']
+    assert [paper['arXiv'][-10:] for paper in reviewed] == ['2610.00001', '2610.00003']
+    assert reviewed[1]['notes'] == "Also good"
@@ -0,0 +1,140 @@
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+# Off unless enable() is called (main.py --trace), until then span() hands out a shared no-op
+_enabled = False
+_origin = time.perf_counter()
+_events = []
+_counters = defaultdict(float)
+_lock = threading.Lock()
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        event = dict(name=self.name, cat=self.name.split('.')[0], ph='X', pid=os.getpid(),
+                     tid=threading.get_ident(), ts=(self.start - _origin) * 1e6, dur=(end - self.start) * 1e6,
+                     args=self.args)
+        with _lock:
+            _events.append(event)
+        return False
+
+    def set(self, **args):
+        """Attach values only known once the work is done, e.g. response sizes."""
+        self.args.update(args)
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def enabled():
+    return _enabled
+
+
+def span(name, **args):
+    """Context manager timing a stage, named '<category>.<stage>'."""
+    if not _enabled:
+        return NULL_SPAN
+    return Span(name, args)
+
+
+def traced(name):
+    """Decorator form of span."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with Span(name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] += value
+
+
+def span_totals():
+    """name -> (calls, total seconds, max seconds)."""
+    totals = defaultdict(lambda: [0, 0.0, 0.0])
+    with _lock:
+        for event in _events:
+            total = totals[event['name']]
+            total[0] += 1
+            total[1] += event['dur'] / 1e6
+            total[2] = max(total[2], event['dur'] / 1e6)
+    return {name: tuple(total) for name, total in totals.items()}
+
+
+def counters():
+    with _lock:
+        return dict(_counters)
+
+
+def print_summary():
+    if not _enabled:
+        return
+    totals = span_totals()
+    if totals:
+        print(f"{'span':<28}{'calls':>8}{'total s':>10}{'avg ms':>10}{'max ms':>10}")
+        for name, (calls, total, longest) in sorted(totals.items()):
+            print(f"{name:<28}{calls:>8}{total:>10.2f}{total / calls * 1e3:>10.1f}{longest * 1e3:>10.1f}")
+
+    current = counters()
+    if not current:
+        return
+    print(f"{'counter':<40}{'value':>14}")
+    for name, value in sorted(current.items()):
+        print(f"{name:<40}{value:>14,.0f}")
+    # Caches count '<cache>.hit' and '<cache>.miss'
+    caches = sorted({name.rsplit('.', 1)[0] for name in current if name.endswith(('.hit', '.miss'))})
+    for cache in caches:
+        hits, misses = current.get(f"{cache}.hit", 0), current.get(f"{cache}.miss", 0)
+        print(f"{cache + ' hit rate':<40}{hits / (hits + misses):>14.0%}")
+
+
+def write_trace(path):
+    """Write the spans as a Chrome trace (chrome://tracing, Perfetto), counters go in otherData."""
+    if not _enabled:
+        return
+    with _lock:
+        trace = dict(traceEvents=list(_events), displayTimeUnit='ms', otherData=dict(_counters))
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(trace))
+    print(f"Trace written to {path}")
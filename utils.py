@@ -33,5 +33,22 @@ def get_last_monday():
     return days, last_monday
 
 
+def week_monday(day):
+    """Monday of the week of a 'YYYY-MM-DD' day, in the same format."""
+    date = datetime.strptime(day, '%Y-%m-%d')
+    return (date - timedelta(days=date.weekday())).strftime('%Y-%m-%d')
+
+
+def weekdays(first_day, last_day):
+    """Every Monday to Friday from first_day to last_day included, as 'YYYY-MM-DD'."""
+    day, last = datetime.strptime(first_day, '%Y-%m-%d'), datetime.strptime(last_day, '%Y-%m-%d')
+    days = []
+    while day <= last:
+        if day.weekday() < 5:
+            days.append(day.strftime('%Y-%m-%d'))
+        day += timedelta(days=1)
+    return days
+
+
 def full_url(spreadsheet_id):
     return f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}"